@@ -19,9 +19,11 @@
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 # SOFTWARE.
 import importlib
+import json
 import logging
 import os
 import sys
+import time
 from abc import ABC, abstractmethod
 from getopt import getopt
 
@@ -34,12 +36,40 @@ class ProgConf:
 	cmd = None
 	override_vl = None
 	ctx = None
+	use_cache = True
+	conf_cache = None
+	report_times = False
+	t_start = time.perf_counter()
+	load_times = dict[str, float]()
 
 	def alloc_ctx ():
-		ProgConf.ctx = palhm.setup_conf(palhm.load_conf(ProgConf.conf))
+		t = time.perf_counter()
+		if ProgConf.use_cache:
+			ProgConf.conf_cache = palhm.ConfCache(ProgConf.conf)
+			jobj = ProgConf.conf_cache.load()
+			k = "conf:" + ("hit" if ProgConf.conf_cache.hit else "miss")
+		else:
+			jobj = palhm.load_conf(ProgConf.conf)
+			k = "conf:nocache"
+		ProgConf.load_times[k] = time.perf_counter() - t
+
+		t = time.perf_counter()
+		ProgConf.ctx = palhm.setup_conf(jobj)
+		ProgConf.load_times["context"] = time.perf_counter() - t
 		if not ProgConf.override_vl is None:
 			ProgConf.ctx.l.setLevel(ProgConf.override_vl)
 
+	def print_times ():
+		times = dict(ProgConf.load_times)
+		if ProgConf.ctx:
+			times |= ProgConf.ctx.load_times
+		times["total"] = time.perf_counter() - ProgConf.t_start
+		# including the interpreter startup and the imports
+		times["cpu"] = time.process_time()
+
+		for k, v in times.items():
+			sys.stderr.write("palhm time: %10.3f ms | %s\n" % (v * 1000, k))
+
 def err_unknown_cmd ():
 	sys.stderr.write("Unknown command. Run '" + sys.argv[0] + " help' for usage.\n")
 	exit(2)
@@ -50,18 +80,35 @@ class Cmd (ABC):
 		...
 
 class ConfigCmd (Cmd):
-	def __init__ (self, *args, **kwargs):
-		pass
+	def __init__ (self, optlist, args):
+		self.optlist = optlist
+		self.args = args
 
 	def do_cmd (self):
+		optlist, _ = getopt(self.args, "", [ "cache" ])
 		ProgConf.alloc_ctx()
-		print(ProgConf.ctx)
+
+		if ("--cache", "") in optlist:
+			cache = ProgConf.conf_cache
+			if cache is None:
+				print("disabled")
+				return 0
+
+			print("%s %s" % ("hit" if cache.hit else "miss", cache.cache_path))
+			for i in cache.deps:
+				print("  " + i[0])
+		else:
+			print(ProgConf.ctx)
+
 		return 0
 
 	def print_help ():
 		print(
-"Usage: " + sys.argv[0] + " config" + '''
-Load and parse config. Print the structure to stdout.''')
+"Usage: " + sys.argv[0] + " config [--cache]" + '''
+Load and parse config. Print the structure to stdout.
+Options:
+  --cache  print whether the config was loaded from the cache and the files
+           in the include graph instead''')
 
 class RunCmd (Cmd):
 	def __init__ (self, optlist, args):
@@ -76,7 +123,10 @@ class RunCmd (Cmd):
 		else:
 			task = palhm.DEFAULT.RUN_TASK.value
 
-		ProgConf.ctx.task_map[task].run(ProgConf.ctx)
+		try:
+			ProgConf.ctx.task_map[task].run(ProgConf.ctx)
+		finally:
+			ProgConf.ctx.join_bg()
 
 		return 0
 
@@ -86,6 +136,93 @@ class RunCmd (Cmd):
 Run a task in config. Run the "''' + palhm.DEFAULT.RUN_TASK.value +
 '''" task if [TASK] is not specified.''')
 
+class ReindexCmd (Cmd):
+	def __init__ (self, optlist, args):
+		self.optlist = optlist
+		self.args = args
+
+	def do_cmd (self):
+		ProgConf.alloc_ctx()
+
+		if not self.args:
+			ReindexCmd.print_help()
+			return 2
+
+		task = ProgConf.ctx.task_map[self.args[0]]
+		if not isinstance(task, palhm.BackupTask):
+			raise InvalidConfigError("Not a backup task", self.args[0])
+		task.bb.rebuild_index(ProgConf.ctx)
+
+		return 0
+
+	def print_help ():
+		print(
+"Usage: " + sys.argv[0] + " reindex TASK" + '''
+Rebuild the index of the backup copies on the backend of the backup task.''')
+
+class VerifyCmd (Cmd):
+	def __init__ (self, optlist, args):
+		self.optlist = optlist
+		self.args = args
+
+	def do_cmd (self):
+		ProgConf.alloc_ctx()
+
+		optlist, args = getopt(self.args, "a")
+		verify_all = ("-a", "") in optlist
+		if not args:
+			VerifyCmd.print_help()
+			return 2
+
+		task = ProgConf.ctx.task_map[args[0]]
+		if not isinstance(task, palhm.BackupTask):
+			raise InvalidConfigError("Not a backup task", args[0])
+		if isinstance(task.bb, palhm.MultiBackupBackend):
+			bbs = task.bb.bbs
+		else:
+			bbs = [ task.bb ]
+
+		nb_objs = 0
+		nb_bytes = 0
+		nb_bad = 0
+		nb_skipped = 0
+		t = time.monotonic()
+		for bb in bbs:
+			if args[1:]:
+				copies = args[1:]
+			elif verify_all:
+				copies = bb.copies(ProgConf.ctx)
+			else:
+				copies = bb.copies(ProgConf.ctx)[-1:]
+
+			for r in bb.verify(ProgConf.ctx, copies):
+				print(r, flush = True)
+				nb_objs += 1
+				nb_bytes += r.nb_bytes
+				if r.status() == "NO-CHECKSUM":
+					nb_skipped += 1
+				elif r.status() != "OK":
+					nb_bad += 1
+		t = time.monotonic() - t
+
+		print("%u objects, %u bytes in %.3fs, %.2f MB/s, %u failed, %u without checksum" % (
+			nb_objs,
+			nb_bytes,
+			t,
+			nb_bytes / t / 1000000 if t else 0.0,
+			nb_bad,
+			nb_skipped))
+
+		return 1 if nb_bad else 0
+
+	def print_help ():
+		print(
+"Usage: " + sys.argv[0] + " verify [-a] TASK [COPY ...]" + '''
+Verify the backup copies of the backup task against the checksums in their
+manifests. The most recent copy is verified if no copy is specified.
+Options:
+  -a  verify all the copies''')
+
 class ModsCmd (Cmd):
 	def __init__ (self, *args, **kwargs):
 		pass
@@ -150,14 +287,73 @@ class BootReportCmd (Cmd):
 "Usage: " + sys.argv[0] + " boot-report" + '''
 Send mail of boot report to recipients configured.''')
 
+class BenchCmd (Cmd):
+	def __init__ (self, optlist, args):
+		self.optlist = optlist
+		self.args = args
+
+	def do_cmd (self):
+		bench = importlib.import_module("palhm.bench")
+		param = bench.BenchParam()
+		as_json = False
+
+		optlist, _ = getopt(self.args, "n:s:d:t:b:w:r:D:B:E:P:j")
+		for p in optlist:
+			if p[0] == "-n": param.nb_objects = int(p[1])
+			elif p[0] == "-s": param.size = bench.parse_size(p[1])
+			elif p[0] == "-d": param.depth = int(p[1])
+			elif p[0] == "-t": param.shapes = p[1].split(",")
+			elif p[0] == "-b": param.backends = p[1].split(",")
+			elif p[0] == "-w": param.nb_workers = int(p[1])
+			elif p[0] == "-r": param.rounds = int(p[1])
+			elif p[0] == "-D": param.root = p[1]
+			elif p[0] == "-B": param.s3_bucket = p[1]
+			elif p[0] == "-E": param.s3_endpoint = p[1]
+			elif p[0] == "-P": param.s3_profile = p[1]
+			elif p[0] == "-j": as_json = True
+
+		if as_json:
+			print(json.dumps([ i.to_jobj() for i in bench.run_bench(param) ]))
+		else:
+			print(bench.BenchResult.header())
+			for i in bench.run_bench(param):
+				print(i, flush = True)
+
+		return 0
+
+	def print_help ():
+		print(
+"Usage: " + sys.argv[0] + " bench [options]" + '''
+Run synthetic backup tasks and report the performance figures.
+Options:
+  -n NB        number of objects per task. Defaults to 16
+  -s SIZE      size of each object. K, M and G suffixes accepted. Defaults to 1M
+  -d DEPTH     number of processes in each pipeline. Defaults to 1
+  -t SHAPES    comma separated dependency shapes: flat, chain and fan-in.
+               Defaults to all
+  -b BACKENDS  comma separated backends: null, localfs and aws-s3. Defaults to
+               null,localfs
+  -w NB        nb-workers. Defaults to 0($(nproc))
+  -r NB        number of rounds for each combination. Defaults to 1
+  -D DIR       directory to create the localfs backend root in
+  -B BUCKET    S3 bucket for aws-s3
+  -E URL       S3 endpoint URL for aws-s3(e.g. moto server)
+  -P PROFILE   AWS profile for aws-s3
+  -j           print the results in JSON
+Columns:
+  OBJS/s, MB/s  objects and bytes per second
+  FORK          estimated time spent on spawning child processes
+  RSS, CRSS     peak RSS of the process and its children so far
+  IDLE          worker time not spent on running objects''')
+
 class HelpCmd (Cmd):
 	def __init__ (self, optlist, args):
 		self.optlist = optlist
 		self.args = args
 
 	def do_cmd (self):
-		if len(self.args) >= 2:
-			if not args[0] in CmdMap:
+		if self.args:
+			if not self.args[0] in CmdMap:
 				err_unknown_cmd()
 			else:
 				CmdMap[self.args[0]].print_help()
@@ -173,6 +369,9 @@ Options:
   -q       Set the verbosity level to 0(CRITIAL). Overrides config
   -v       Increase the verbosity level by 1. Overrides config
   -f FILE  Load config from FILE instead of the hard-coded default
+  -n       Do not use the config cache
+  -t       Print the time spent on loading config, modules and tasks to
+           stderr on exit
 Config: ''' + ProgConf.conf + '''
 Commands:
   run          run a task
@@ -180,7 +379,10 @@ Commands:
   help [CMD]   print this message and exit normally if [CMD] is not specified.
                Print usage of [CMD] otherwise
   mods         list available modules
-  boot-report  mail boot report''')
+  boot-report  mail boot report
+  reindex      rebuild the index of backup copies
+  verify       verify backup copies against checksums
+  bench        run backup benchmark''')
 
 		return 0
 
@@ -189,10 +391,13 @@ CmdMap = {
 	"run": RunCmd,
 	"help": HelpCmd,
 	"mods": ModsCmd,
-	"boot-report": BootReportCmd
+	"boot-report": BootReportCmd,
+	"reindex": ReindexCmd,
+	"verify": VerifyCmd,
+	"bench": BenchCmd
 }
 
-optlist, args = getopt(sys.argv[1:], "qvf:")
+optlist, args = getopt(sys.argv[1:], "qvf:nt")
 optkset = set()
 for p in optlist:
 	optkset.add(p[0])
@@ -212,9 +417,16 @@ for p in optlist:
 		else:
 			ProgConf.override_vl -= 10
 	elif p[0] == "-f": ProgConf.conf = p[1]
+	elif p[0] == "-n": ProgConf.use_cache = False
+	elif p[0] == "-t": ProgConf.report_times = True
 
 logging.basicConfig(format = "%(name)s %(message)s")
 
 ProgConf.cmd = CmdMap[args[0]](optlist, args)
 del args[0]
-exit(ProgConf.cmd.do_cmd())
+try:
+	ec = ProgConf.cmd.do_cmd()
+finally:
+	if ProgConf.report_times:
+		ProgConf.print_times()
+exit(ec)
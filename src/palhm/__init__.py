@@ -17,30 +17,45 @@
 # LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 # SOFTWARE.
+import bz2
+import lzma
+import marshal
 import platform
+import random
 import resource
 import sys
 import time
 import math
+import zlib
 
 from .exceptions import InvalidConfigError
+import errno
+import fcntl
+import hashlib
 import json
 import logging
+import mmap
 import os
 import re
+import select
+import selectors
 import shutil
 import signal
 import subprocess
+import threading
 from abc import ABC, abstractmethod
+from collections import deque
 from concurrent import futures
-from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import Future, ThreadPoolExecutor
 from contextlib import contextmanager
 from copy import deepcopy
 from datetime import datetime, timezone
 from decimal import Decimal
 from enum import Enum
 from importlib import import_module
-from typing import Iterable
+import queue
+from queue import Queue
+from typing import Iterable, Union
 
 
 def default_workers ():
@@ -54,6 +69,14 @@ class DEFAULT (Enum):
 	OBJ_GRP = "default"
 	NB_WORKERS = default_workers()
 	RUN_TASK = "default"
+	CHILD_IO_SIZE = 65536
+	HIST_ALPHA = 0.5
+	TEE_BUFS = 16
+	EVENT_WORKERS = 4
+	EVENT_FEEDS = 16
+	FILTER_BUFS = 4
+	COMPRESS_BLOCK_SIZE = 4194304
+	VERIFY_BUF_SIZE = 8388608
 
 def trans_vl (x: int) -> int:
 	return 50 - x * 10
@@ -71,39 +94,83 @@ class ValidObject (ABC):
 	def validate (self):
 		...
 
+class ModRegistry (dict):
+	'''
+	The map of the names of the backends or MUAs to the classes. The modules
+	are imported on lookup misses so that the modules not used by the task
+	being run are never imported.
+	'''
+	def __init__ (self, ctx, attr: str, desc: str, builtins: dict):
+		super().__init__(builtins)
+		self.ctx = ctx
+		self.attr = attr
+		self.desc = desc
+
+	def __missing__ (self, key):
+		while key not in self and self.ctx.load_next_mod():
+			pass
+		if key in self:
+			return self[key]
+		raise KeyError(key)
+
+	def load_all (self):
+		while self.ctx.load_next_mod():
+			pass
+
+class TaskMap (dict):
+	'''
+	The map of the task ids to the tasks. The tasks are instantiated from the
+	definitions when they are first looked up.
+	'''
+	def __init__ (self, ctx):
+		super().__init__()
+		self.ctx = ctx
+		self.defs = dict[str, dict]()
+		self.pending = set[str]()
+
+	def __missing__ (self, key):
+		if key in self.pending:
+			raise InvalidConfigError("Circular task reference", key)
+
+		jobj = self.defs[key]
+		self.pending.add(key)
+		try:
+			t = time.perf_counter()
+			task = self[key] = TaskClassMap[jobj["type"]](self.ctx, jobj)
+			self.ctx.load_times["task:" + key] = time.perf_counter() - t
+		finally:
+			self.pending.remove(key)
+
+		return task
+
+	def __contains__ (self, key) -> bool:
+		return key in self.defs
+
+	def load_all (self):
+		for i in self.defs:
+			self[i]
+
+	def items (self):
+		self.load_all()
+		return super().items()
+
+	def keys (self):
+		return self.defs.keys()
+
 class GlobalContext:
 	def __init__ (self, jobj: dict):
-		def chk_conflict (a: dict, b: dict, msg: str):
-			comm = set(a.keys()).intersection(b.keys())
-			if comm:
-				raise InvalidConfigError(msg, comm)
-
 		self.modules = {}
-		self.backup_backends = dict[str, BackupBackend]({
+		self.load_times = dict[str, float]()
+		self.mod_queue = list(jobj.get("modules", iter(())))
+		self.backup_backends = ModRegistry(self, "backup_backends", "Backup Backend", {
 			"null": NullBackupBackend,
 			"localfs": LocalfsBackupBackend
 		})
-		self.muas = dict[str, MUA]({
+		self.muas = ModRegistry(self, "muas", "MUA", {
 			"mailx": MailxMUA,
 			"stdout": StdoutMUA
 		})
 
-		for m in jobj.get("modules", iter(())):
-			loaded = self.modules[m] = import_module("." + m, "palhm.mod")
-
-			if hasattr(loaded, "backup_backends"):
-				chk_conflict(
-					self.backup_backends,
-					loaded.backup_backends,
-					"Backup Backend conflict detected")
-				self.backup_backends |= loaded.backup_backends
-			if hasattr(loaded, "muas"):
-				chk_conflict(
-					self.muas,
-					loaded.muas,
-					"MUA conflict detected")
-				self.muas |= loaded.muas
-
 		self.nb_workers = jobj.get("nb-workers", DEFAULT.NB_WORKERS.value)
 		if self.nb_workers == 0:
 			self.nb_workers = default_workers()
@@ -114,21 +181,131 @@ class GlobalContext:
 		else:
 			self.vl = DEFAULT.VL.value
 		self.exec_map = {}
-		self.task_map = {}
+		self.task_map = TaskMap(self)
+		self.bg_jobs = list[threading.Thread]()
+		self.bg_errors = list[BaseException]()
 		self.l = logging.getLogger("palhm")
 		self.l.setLevel(self.vl)
-
+		self.child_io_size = int(jobj.get(
+			"child-io-size",
+			DEFAULT.CHILD_IO_SIZE.value))
+		self.pipe_size = jobj.get("pipe-size")
+		self.state_dir = jobj.get("state-dir")
+		self.budget = jobj.get("budget", {})
+		if self.child_io_size <= 0:
+			raise InvalidConfigError("Invalid 'child-io-size'", self.child_io_size)
+
+		budget = ResourceBudget(self.budget)
 		for i in jobj.get("execs", iter(())):
 			self.exec_map[i["id"]] = Exec(i)
+			budget.chk_cost(self.exec_map[i["id"]].cost, i["id"])
 		for i in jobj.get("tasks", iter(())):
-			self.task_map[i["id"]] = TaskClassMap[i["type"]](self, i)
-
-		self.child_io_size = 4096
-
-		self.boot_report = (
-			BootReport(self, jobj["boot-report"]) if "boot-report" in jobj
-			else None)
+			self.task_map.defs[i["id"]] = i
+
+		self.throttle = TokenBucket.from_conf(jobj.get("throttle"))
+		self.boot_report_jobj = jobj.get("boot-report")
+		self._boot_report = None
+
+		self.child_output = {
+			"mode": "inherit",
+			"tail": 20,
+			"rate": 100
+		} | jobj.get("child-output", {})
+		self.output_mux = None
+		self.output_mux_lock = threading.Lock()
+		if self.child_output["mode"] not in ( "inherit", "log" ):
+			raise InvalidConfigError(
+				"Invalid 'mode' in 'child-output'",
+				self.child_output["mode"])
+		if self.child_output["tail"] < 0:
+			raise InvalidConfigError(
+				"Invalid 'tail' in 'child-output'",
+				self.child_output["tail"])
+		if self.child_output["rate"] is not None:
+			self.child_output["rate"] = float(self.child_output["rate"])
+			if self.child_output["rate"] <= 0:
+				raise InvalidConfigError(
+					"Invalid 'rate' in 'child-output'",
+					self.child_output["rate"])
+
+	def capture (self, tag: str, stream: str, vl: int):
+		'''
+		Get the stdout or stderr for the child process to be spawned.
+		'''
+		if self.child_output["mode"] == "inherit":
+			return ChildOutput(self, vl)
+
+		with self.output_mux_lock:
+			if self.output_mux is None:
+				self.output_mux = OutputMux()
+
+		return LoggedOutput(self, tag, stream, vl)
+
+	def load_next_mod (self) -> bool:
+		'''
+		Import the next module in the "modules" list and register the backends
+		and MUAs it provides. Return False if all the modules are imported.
+		'''
+		def chk_conflict (a: dict, b: dict, msg: str):
+			comm = set(a.keys()).intersection(b.keys())
+			if comm:
+				raise InvalidConfigError(msg, comm)
 
+		if not self.mod_queue:
+			return False
+
+		m = self.mod_queue.pop(0)
+		t = time.perf_counter()
+		loaded = self.modules[m] = import_module("." + m, "palhm.mod")
+		self.load_times["module:" + m] = time.perf_counter() - t
+
+		for r in (self.backup_backends, self.muas):
+			provided = getattr(loaded, r.attr, None)
+			if provided:
+				chk_conflict(r, provided, r.desc + " conflict detected")
+				r.update(provided)
+
+		return True
+
+	def load_all (self):
+		'''
+		Import all the modules and instantiate all the tasks to validate the
+		whole config.
+		'''
+		self.backup_backends.load_all()
+		self.task_map.load_all()
+		self.boot_report
+
+	@property
+	def boot_report (self):
+		if self._boot_report is None and self.boot_report_jobj is not None:
+			self._boot_report = BootReport(self, self.boot_report_jobj)
+		return self._boot_report
+
+	def run_bg (self, name: str, f, *args, **kwargs):
+		'''
+		Run the job in the background. The process waits for the job before
+		exiting.
+		'''
+		def main ():
+			try:
+				f(*args, **kwargs)
+			except BaseException as e:
+				self.l.error("background job %s failed: %s" % (name, repr(e)))
+				self.bg_errors.append(e)
+
+		th = threading.Thread(target = main, name = name)
+		self.bg_jobs.append(th)
+		th.start()
+
+	def join_bg (self):
+		'''
+		Wait for the background jobs. Raise the first exception from them.
+		'''
+		while self.bg_jobs:
+			self.bg_jobs.pop(0).join()
+		if self.bg_errors:
+			raise self.bg_errors[0]
 
 	def get_vl (self) -> int:
 		return self.vl
@@ -140,12 +317,19 @@ class GlobalContext:
 		return x <= self.get_vl()
 
 	def test_workers (self, n: int) -> bool:
+		if self.nb_workers is None:
+			return True
 		return n <= self.nb_workers if n > 0 else True
 
 	def __str__ (self) -> str:
+		self.load_all()
 		return "\n".join([
 			"nb_workers: " + str(self.nb_workers),
 			"vl: " + str(self.vl),
+			"child_io_size: " + str(self.child_io_size),
+			"pipe_size: " + str(self.pipe_size),
+			"state_dir: " + str(self.state_dir),
+			"budget: " + str(ResourceBudget(self.budget)),
 			"modules: " + " ".join([ i for i in self.modules ]),
 			"backup_backends: " + " ".join([ i for i in self.backup_backends.keys() ]),
 			"muas: " + " ".join([ i for i in self.muas.keys() ]),
@@ -154,6 +338,153 @@ class GlobalContext:
 			"boot-report:\n\t" + (str(self.boot_report).replace("\n", "\n\t") if self.boot_report else "")
 		]).replace("\t", "  ")
 
+class HostFacts:
+	'''
+	The collectors of the facts about the host for the boot report. The facts
+	are read directly from procfs and sysfs without spawning child processes.
+	'''
+	def _read (path: str) -> str:
+		with open(path) as f:
+			return f.read()
+
+	def _uptime_sec () -> float:
+		return float(HostFacts._read("/proc/uptime").split()[0])
+
+	def btime () -> int:
+		for l in HostFacts._read("/proc/stat").splitlines():
+			if l.startswith("btime "):
+				return int(l.split()[1])
+		raise KeyError("btime")
+
+	def uptime_since () -> str:
+		# Same as `uptime --since`
+		return datetime.fromtimestamp(HostFacts.btime()).strftime(
+			"%Y-%m-%d %H:%M:%S")
+
+	def uptime () -> str:
+		# Same as `uptime -p`
+		m = int(HostFacts._uptime_sec()) // 60
+		ret = list[str]()
+
+		for unit, n in (
+				("week", m // 10080),
+				("day", m // 1440 % 7),
+				("hour", m // 60 % 24),
+				("minute", m % 60)):
+			if n:
+				ret.append("%d %s%s" % (n, unit, "" if n == 1 else "s"))
+
+		return "up " + (", ".join(ret) if ret else "0 minutes")
+
+	def boot_id () -> str:
+		return HostFacts._read("/proc/sys/kernel/random/boot_id").strip()
+
+	def meminfo () -> dict:
+		'''
+		The values in bytes or the number of pages.
+		'''
+		ret = {}
+
+		for l in HostFacts._read("/proc/meminfo").splitlines():
+			k, v = l.split(":", 1)
+			v = v.split()
+			ret[k] = int(v[0]) * 1024 if v[1:] == [ "kB" ] else int(v[0])
+
+		return ret
+
+	def loadavg () -> dict:
+		v = HostFacts._read("/proc/loadavg").split()
+		running, total = v[3].split("/")
+
+		return {
+			"load": [ float(i) for i in v[:3] ],
+			"running": int(running),
+			"total": int(total)
+		}
+
+	def psi () -> dict:
+		ret = {}
+
+		for r in ( "cpu", "memory", "io" ):
+			try:
+				doc = HostFacts._read("/proc/pressure/" + r)
+			except FileNotFoundError:
+				continue # kernel without CONFIG_PSI
+
+			ret[r] = {}
+			for l in doc.splitlines():
+				v = l.split()
+				ret[r][v[0]] = {
+					k: (int(x) if k == "total" else float(x))
+					for k, x in (i.split("=") for i in v[1:]) }
+
+		return ret
+
+	def mounts () -> list:
+		'''
+		The usage of the file systems backed by devices. The mounts that
+		cannot be queried(e.g. stale NFS mounts) are reported with the error.
+		'''
+		nodev = set[str]()
+		for l in HostFacts._read("/proc/filesystems").splitlines():
+			v = l.split()
+			if len(v) == 2 and v[0] == "nodev":
+				nodev.add(v[1])
+
+		ret = list[dict]()
+		for l in HostFacts._read("/proc/self/mounts").splitlines():
+			src, mp, fstype = l.split()[:3]
+			if fstype in nodev:
+				continue
+
+			# octal escapes for spaces and such
+			mp = re.sub(r"\\([0-7]{3})", lambda m: chr(int(m[1], 8)), mp)
+			ent = {
+				"source": src,
+				"mountpoint": mp,
+				"fstype": fstype
+			}
+			ret.append(ent)
+			try:
+				st = os.statvfs(mp)
+			except OSError as e:
+				ent["error"] = e.strerror
+				continue
+
+			ent |= {
+				"size": st.f_blocks * st.f_frsize,
+				"used": (st.f_blocks - st.f_bfree) * st.f_frsize,
+				"avail": st.f_bavail * st.f_frsize,
+				"inodes": st.f_files,
+				"inodes-free": st.f_favail
+			}
+
+		return ret
+
+	def collect (facts: Iterable[str]) -> dict:
+		'''
+		Collect the facts concurrently. The facts are returned in the order
+		specified.
+		'''
+		facts = list(facts)
+		if not facts:
+			return {}
+
+		with ThreadPoolExecutor(len(facts)) as th_pool:
+			fl = [ th_pool.submit(HostFactMap[i]) for i in facts ]
+			return { i: f.result() for i, f in zip(facts, fl) }
+
+HostFactMap = {
+	"uptime-since": HostFacts.uptime_since,
+	"uptime": HostFacts.uptime,
+	"boot-id": HostFacts.boot_id,
+	"btime": HostFacts.btime,
+	"meminfo": HostFacts.meminfo,
+	"loadavg": HostFacts.loadavg,
+	"psi": HostFacts.psi,
+	"mounts": HostFacts.mounts
+}
+
 class BootReport:
 	def _hostname () -> str:
 		return platform.node()
@@ -180,6 +511,8 @@ class BootReport:
 			"More details as follows.")
 
 	def _bootwait_systemd ():
+		# The system state is only exposed over D-Bus. The only child process
+		# of the boot report
 		argv = [
 			"/usr/bin/systemctl",
 			"is-system-running",
@@ -195,15 +528,23 @@ class BootReport:
 
 	def __init__ (self, ctx: GlobalContext, jobj: dict):
 		def do_nothing(): pass
-		self.yaml = import_module("yaml")
 
 		self.mua = ctx.muas[jobj["mua"]](jobj.get("mua-param", {}))
 		self.recipients = jobj["mail-to"]
 		self.subject = jobj.get("subject", BootReport._default_subject())
 		self.header = jobj.get("header", BootReport._default_header())
-		self.uptime_since = jobj.get("uptime-since", True)
-		self.uptime = jobj.get("uptime", True)
-		self.bootid = jobj.get("boot-id", True)
+		if "facts" in jobj:
+			self.facts = list[str](jobj["facts"])
+		else:
+			# the legacy switches
+			self.facts = [ k for k, v in (
+				("uptime-since", jobj.get("uptime-since", True)),
+				("uptime", jobj.get("uptime", True)),
+				("boot-id", jobj.get("boot-id", jobj.get("bootid", True)))
+			) if v ]
+		for i in self.facts:
+			if i not in HostFactMap:
+				raise InvalidConfigError("Unknown fact", i)
 		self.bootwait = jobj.get("boot-wait")
 		self.delay = float(jobj.get("delay", 0))
 
@@ -232,33 +573,9 @@ class BootReport:
 		body["hostname"] = BootReport._hostname()
 		body["tz"] = list(time.tzname) + [time.timezone]
 
-		if self.uptime_since:
-			with subprocess.Popen(
-				[ "/bin/uptime", "--since" ],
-				stdin = subprocess.DEVNULL,
-				stdout = subprocess.PIPE) as p:
-				body["uptime-since"] = str(
-					p.stdout.read(ctx.child_io_size)).strip()
-
-				if p.wait() != 0:
-					raise ChildProcessError(p)
-
-		if self.uptime:
-			with subprocess.Popen(
-				[ "/bin/uptime", "-p" ],
-				stdin = subprocess.DEVNULL,
-				stdout = subprocess.PIPE) as p:
-				body["uptime"] = str(
-					p.stdout.read(ctx.child_io_size)).strip()
-
-				if p.wait() != 0:
-					raise ChildProcessError(p)
-
-		if self.bootid:
-			with open("/proc/sys/kernel/random/boot_id") as f:
-				body["bood-id"] = f.readline(36)
+		body |= HostFacts.collect(self.facts)
 
-		yield self.yaml.dump(root_doc)
+		yield import_module("yaml").dump(root_doc)
 
 	def do_send (self, ctx: GlobalContext) -> int:
 		self.bootwait_f()
@@ -275,21 +592,319 @@ class BootReport:
 recipients: {recipients}
 subject: {subject}
 header: {header}
-uptime_since: {uptime_since}
-uptime: {uptime}
-bootid: {bootid}
+facts: {facts}
 bootwait: {bootwait}
 delay: {delay}'''.format(
 		mua = str(self.mua).replace("\n", "\n\t"),
 		recipients = "".join([ "\n\t- " + repr(i) for i in self.recipients]),
 		subject = repr(self.subject),
 		header = repr(self.header),
-		uptime_since = self.uptime_since,
-		uptime = self.uptime,
-		bootid = self.bootid,
+		facts = " ".join(self.facts),
 		bootwait = self.bootwait,
 		delay = self.delay)
 
+class TokenBucket:
+	'''
+	Thread-safe token bucket. The tokens are taken in advance so that a large
+	request does not block forever. The debt is paid back by waiting.
+	'''
+	def from_conf (jobj: dict):
+		if jobj is None:
+			return None
+		rate = float(jobj["rate"])
+		burst = float(jobj.get("burst", rate))
+		if not math.isfinite(rate) or rate <= 0:
+			raise InvalidConfigError("Invalid 'rate'", jobj["rate"])
+		if not math.isfinite(burst) or burst <= 0:
+			raise InvalidConfigError("Invalid 'burst'", jobj.get("burst"))
+
+		return TokenBucket(rate, burst)
+
+	def __init__ (self, rate: float, burst: float):
+		self.rate = rate
+		self.burst = burst
+		self.tokens = burst
+		self.t_last = time.monotonic()
+		self.lock = threading.Lock()
+
+	def _refill (self):
+		now = time.monotonic()
+		self.tokens = min(
+			self.burst,
+			self.tokens + (now - self.t_last) * self.rate)
+		self.t_last = now
+
+	def reserve (self, n: float) -> float:
+		'''
+		Take n tokens. Return the number of seconds to wait before using them.
+		'''
+		with self.lock:
+			self._refill()
+			self.tokens -= n
+			ret = -self.tokens / self.rate if self.tokens < 0 else 0.0
+
+		return ret
+
+	def take (self, n: float) -> float:
+		ret = self.reserve(n)
+		if ret > 0:
+			time.sleep(ret)
+		return ret
+
+	def try_take (self, n: float) -> bool:
+		with self.lock:
+			self._refill()
+			if self.tokens < n:
+				return False
+			self.tokens -= n
+
+		return True
+
+	def __str__ (self) -> str:
+		return "%.0f B/s, burst %.0f B" % (self.rate, self.burst)
+
+class ChildOutput:
+	'''
+	The stdout or stderr of a child process inherited from PALHM or discarded
+	depending on the verbosity level.
+	'''
+	def __init__ (self, ctx: GlobalContext, vl: int):
+		self.fd = None if ctx.test_vl(vl) else subprocess.DEVNULL
+
+	def spawned (self, pid: int):
+		pass
+
+	def tail (self) -> list[str]:
+		return []
+
+class LoggedOutput (ChildOutput):
+	'''
+	The stdout or stderr of a child process read by the output multiplexer.
+	Each line is logged as a record tagged with the name of the child. The
+	last lines are kept regardless of the verbosity level so that they can be
+	reported when the child fails.
+	'''
+	MAX_LINE = 4096
+
+	def __init__ (
+			self,
+			ctx: GlobalContext,
+			tag: str,
+			stream: str,
+			vl: int):
+		self.l = ctx.l.getChild("child")
+		self.mux = ctx.output_mux
+		self.tag = tag
+		self.stream = stream
+		self.vl = vl
+		self.emit = ctx.test_vl(vl)
+		self.lines = deque[str](maxlen = ctx.child_output["tail"])
+		rate = ctx.child_output["rate"]
+		self.bucket = None if rate is None else TokenBucket(rate, rate)
+		self.nb_suppressed = 0
+		self.buf = b""
+		self.eof = threading.Event()
+		self.rfd, self.fd = os.pipe()
+		os.set_blocking(self.rfd, False)
+
+	def spawned (self, pid: int):
+		'''
+		Close the write end in the parent after the child is spawned and hand
+		the read end over to the output multiplexer. The pid is None if the
+		child could not be spawned.
+		'''
+		os.close(self.fd)
+		self.fd = None
+		# The tag is set before the multiplexer gets to read the first line
+		if pid is not None:
+			self.tag = "%s[%d]" % (self.tag, pid)
+		self.mux.add(self)
+
+	def _log (self, msg: str, *args):
+		rec = self.l.makeRecord(
+			self.l.name,
+			self.vl,
+			"(child)",
+			0,
+			"%s %s: " + msg,
+			(self.tag, self.stream) + args,
+			None,
+			extra = { "child": self.tag, "stream": self.stream })
+		# The verbosity is tested with test_vl() like the inherited outputs
+		self.l.handle(rec)
+
+	def _flush_suppressed (self):
+		if self.nb_suppressed:
+			self._log("%d line(s) suppressed", self.nb_suppressed)
+			self.nb_suppressed = 0
+
+	def _on_line (self, b: bytes):
+		line = b.decode(errors = "replace").rstrip("\r")
+		self.lines.append(line)
+		if not self.emit:
+			return
+
+		if self.bucket is not None and not self.bucket.try_take(1):
+			self.nb_suppressed += 1
+			return
+
+		self._flush_suppressed()
+		self._log("%s", line)
+
+	def feed (self, b: bytes):
+		self.buf += b
+		while True:
+			pos = self.buf.find(b"\n")
+			if pos < 0:
+				if len(self.buf) >= LoggedOutput.MAX_LINE:
+					self._on_line(self.buf[:LoggedOutput.MAX_LINE])
+					self.buf = self.buf[LoggedOutput.MAX_LINE:]
+					continue
+				break
+			self._on_line(self.buf[:pos])
+			self.buf = self.buf[pos + 1:]
+
+	def close (self):
+		if self.buf:
+			self._on_line(self.buf)
+			self.buf = b""
+		if self.emit:
+			self._flush_suppressed()
+		os.close(self.rfd)
+		self.eof.set()
+
+	def tail (self) -> list[str]:
+		# The grandchildren may hold the pipe open. Don't wait for them
+		self.eof.wait(1.0)
+		return list(self.lines)
+
+def popen_captured (outputs: Iterable[ChildOutput], *args, **kwargs) -> subprocess.Popen:
+	'''
+	subprocess.Popen() that hands the ChildOutputs over to the child.
+	'''
+	p = None
+	try:
+		p = subprocess.Popen(*args, **kwargs)
+	finally:
+		for o in outputs:
+			o.spawned(None if p is None else p.pid)
+	return p
+
+class OutputMux:
+	'''
+	Reads the outputs of all the child processes from one thread.
+	'''
+	def __init__ (self):
+		self.sel = selectors.DefaultSelector()
+		self.lock = threading.Lock()
+		self.new = list[LoggedOutput]()
+		self.wake_r, self.wake_w = os.pipe()
+		os.set_blocking(self.wake_r, False)
+		self.sel.register(self.wake_r, selectors.EVENT_READ)
+		self.th = threading.Thread(
+			target = self._main,
+			name = "output mux",
+			daemon = True)
+		self.th.start()
+
+	def add (self, o: LoggedOutput):
+		with self.lock:
+			self.new.append(o)
+		os.write(self.wake_w, b"\0")
+
+	def _main (self):
+		while True:
+			for key, _ in self.sel.select():
+				if key.data is None:
+					try:
+						os.read(self.wake_r, 4096)
+					except BlockingIOError:
+						pass
+					with self.lock:
+						new, self.new = self.new, list[LoggedOutput]()
+					for o in new:
+						self.sel.register(o.rfd, selectors.EVENT_READ, o)
+					continue
+
+				o = key.data
+				try:
+					b = os.read(o.rfd, 65536)
+				except BlockingIOError:
+					continue
+
+				if b:
+					o.feed(b)
+				else:
+					self.sel.unregister(o.rfd)
+					o.close()
+
+class ResourceBudget:
+	'''
+	The amount of resources the backup objects running at the same time can
+	use. The units are arbitrary and up to the user as long as they are used
+	consistently.
+	'''
+	KEYS = ( "cpu", "io", "mem" )
+
+	def parse_cost (jobj: dict) -> dict:
+		ret = {}
+		for k, v in jobj.items():
+			if not k in ResourceBudget.KEYS:
+				raise InvalidConfigError("Unknown resource", k)
+			v = float(v)
+			if not v >= 0:
+				raise InvalidConfigError("Invalid cost", k, v)
+			ret[k] = v
+		return ret
+
+	def sum_cost (costs: Iterable[dict]) -> dict:
+		ret = {}
+		for c in costs:
+			for k, v in c.items():
+				ret[k] = ret.get(k, 0.0) + v
+		return ret
+
+	def __init__ (self, jobj: dict = {}):
+		self.limit = {}
+		for k, v in jobj.items():
+			if not k in ResourceBudget.KEYS:
+				raise InvalidConfigError("Unknown resource", k)
+			v = float(v)
+			if not v > 0:
+				raise InvalidConfigError("Invalid budget", k, v)
+			self.limit[k] = v
+		self.used = {}
+
+	def chk_cost (self, cost: dict, what: str):
+		'''
+		Raise InvalidConfigError if the cost can never fit in the budget.
+		'''
+		for k, v in cost.items():
+			if v > self.limit.get(k, math.inf):
+				raise InvalidConfigError(
+					"Cost exceeds budget", what, k, v, self.limit[k])
+
+	def test (self, cost: dict) -> bool:
+		for k, v in cost.items():
+			if self.used.get(k, 0.0) + v > self.limit.get(k, math.inf):
+				return False
+		return True
+
+	def acquire (self, cost: dict):
+		for k, v in cost.items():
+			self.used[k] = self.used.get(k, 0.0) + v
+		self.used[None] = self.used.get(None, 0) + 1
+
+	def release (self, cost: dict):
+		for k, v in cost.items():
+			self.used[k] -= v
+		self.used[None] -= 1
+		if self.used[None] == 0:
+			self.used.clear()
+
+	def __str__ (self) -> str:
+		return " ".join([ "%s=%g" % i for i in self.limit.items() ])
+
 class Runnable (ABC):
 	@abstractmethod
 	def run (self, ctx: GlobalContext):
@@ -344,6 +959,10 @@ class Exec (Runnable, ExecvHolder):
 
 		ret.vl_stderr = jobj.get("vl-stderr", ret.vl_stderr)
 		ret.vl_stdout = jobj.get("vl-stdout", ret.vl_stdout)
+		if "cost" in jobj and jobj["type"] != "exec-inline":
+			if ret is exec:
+				ret = deepcopy(exec)
+			ret.cost = ResourceBudget.parse_cost(jobj["cost"])
 
 		return ret
 
@@ -354,12 +973,14 @@ class Exec (Runnable, ExecvHolder):
 			self.ec = Exec.DEFAULT.EC.value
 			self.vl_stderr = Exec.DEFAULT.VL_STDERR.value
 			self.vl_stdout = Exec.DEFAULT.VL_STDOUT.value
+			self.cost = {}
 		else:
 			self.argv = jobj["argv"]
 			self.env = jobj.get("env") or {}
 			self.ec = Exec.parse_ec(jobj.get("ec", "0"))
 			self.vl_stderr = jobj.get("vl-stderr", Exec.DEFAULT.VL_STDERR.value)
 			self.vl_stdout = jobj.get("vl-stdout", Exec.DEFAULT.VL_STDOUT.value)
+			self.cost = ResourceBudget.parse_cost(jobj.get("cost", {}))
 
 	def mkappend (self, extra_argv: Iterable, extra_env: dict = {}):
 		ny = deepcopy(self)
@@ -367,15 +988,26 @@ class Exec (Runnable, ExecvHolder):
 		ny.env |= extra_env
 		return ny
 
+	def capture (self, ctx: GlobalContext, tag: str = None) -> tuple:
+		'''
+		Get the ChildOutputs for the stdout and stderr of the process.
+		'''
+		argv0 = os.path.basename(self.argv[0]) if self.argv else "exec"
+		tag = tag + ":" + argv0 if tag else argv0
+		return (
+			ctx.capture(tag, "stdout", self.vl_stdout),
+			ctx.capture(tag, "stderr", self.vl_stderr))
+
 	def run (self, ctx: GlobalContext):
-		stdout = None if ctx.test_vl(self.vl_stdout) else subprocess.DEVNULL
-		stderr = None if ctx.test_vl(self.vl_stderr) else subprocess.DEVNULL
-		p = subprocess.run(
+		outputs = self.capture(ctx)
+		with popen_captured(
+			outputs,
 			self.argv,
 			env = self.env,
-			stdout = stdout,
-			stderr = stderr)
-		self.raise_oob_ec(p.returncode)
+			stdout = outputs[0].fd,
+			stderr = outputs[1].fd) as p:
+			ec = p.wait()
+		self.raise_oob_ec(ec, outputs)
 
 		return self
 
@@ -388,18 +1020,1048 @@ class Exec (Runnable, ExecvHolder):
 	def test_ec (self, ec: int) -> bool:
 		return ec in self.ec
 
-	def raise_oob_ec (self, ec: int):
+	def raise_oob_ec (self, ec: int, outputs: Iterable[ChildOutput] = ()):
 		if not self.test_ec(ec):
-			raise ChildProcessError(
+			e = ChildProcessError(
 				str(self) + ": exit code test fail",
 				ec,
 				self.ec)
+			e.output_tail = list[str]()
+			for o in outputs:
+				e.output_tail.extend(o.tail())
+			if e.output_tail and hasattr(e, "add_note"):
+				e.add_note("\n".join([ "last output:" ] + e.output_tail))
+			raise e
 
 	def __str__ (self) -> str:
 		return str().join(
 			[ i[0] + "=\"" + i[1] + "\" " for i in self.env.items() ] +
 			[ i + " " for i in self.argv ]).strip()
 
+def set_pipe_size (fd: int, size: int):
+	# Best effort. The pipe size cannot go beyond /proc/sys/fs/pipe-max-size
+	# for unprivileged processes
+	if size is None or not hasattr(fcntl, "F_SETPIPE_SZ"):
+		return
+	try:
+		fcntl.fcntl(fd, fcntl.F_SETPIPE_SZ, size)
+	except OSError:
+		pass
+
+def preallocate (fd: int, size: int) -> bool:
+	'''
+	Reserve the space for the file to reduce fragmentation. Best effort. The
+	file is extended to size. Return False if nothing could be done.
+	'''
+	try:
+		if hasattr(os, "posix_fallocate"):
+			os.posix_fallocate(fd, 0, size)
+			return True
+	except OSError:
+		pass
+
+	# Not supported by the file system or the platform. A sparse file still
+	# saves the metadata updates as the file grows
+	try:
+		os.ftruncate(fd, size)
+	except OSError:
+		return False
+	return True
+
+def write_fully (fd: int, b) -> int:
+	mv = memoryview(b)
+	ret = len(mv)
+
+	while mv:
+		mv = mv[os.write(fd, mv):]
+
+	return ret
+
+def pipe_copy (ctx: GlobalContext, fd_in: int, fd_out: int) -> int:
+	'''
+	Copy the contents of the pipe fd_in to fd_out until EOF. splice() is used
+	where possible so that the data is not copied into the user space.
+	'''
+	ret = 0
+	use_splice = hasattr(os, "splice")
+
+	while use_splice:
+		try:
+			n = os.splice(
+				fd_in,
+				fd_out,
+				ctx.child_io_size,
+				flags = os.SPLICE_F_MOVE | os.SPLICE_F_MORE)
+		except OSError as e:
+			if e.errno in { errno.EINVAL, errno.ENOSYS, errno.EOPNOTSUPP }:
+				# The file system doesn't support splice()
+				use_splice = False
+				break
+			raise
+		if n == 0:
+			return ret
+		ret += n
+
+	while True:
+		b = os.read(fd_in, ctx.child_io_size)
+		if not b:
+			break
+		ret += write_fully(fd_out, b)
+
+	return ret
+
+def file_copy (src: str, dst: str, mode: int) -> int:
+	'''
+	Copy the file using copy_file_range() so that the file system can share
+	the extents(reflink) or copy them without going through the user space.
+	'''
+	ret = 0
+
+	with (open(src, "rb") as f_in,
+		open(os.open(dst, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, mode), "wb") as f_out):
+		try:
+			while True:
+				n = os.copy_file_range(f_in.fileno(), f_out.fileno(), 1 << 30)
+				if n == 0:
+					return ret
+				ret += n
+		except OSError as e:
+			if not e.errno in { errno.EXDEV, errno.EINVAL, errno.ENOSYS, errno.EOPNOTSUPP }:
+				raise
+		# Start over
+		f_in.seek(0)
+		f_out.seek(0)
+		f_out.truncate()
+		shutil.copyfileobj(f_in, f_out)
+
+		return f_out.tell()
+
+class PipeMeter:
+	'''
+	The stats of the data flowing from one pipeline stage to the next.
+
+	idle: the time spent waiting for the stage to produce output
+	stall: the time spent waiting for the next stage to consume the output
+	'''
+	def __init__ (self, stage: str):
+		self.stage = stage
+		self.nb_bytes = 0
+		self.t_start = None
+		self.t_end = None
+		self.idle = 0.0
+		self.stall = 0.0
+
+	def wall (self) -> float:
+		if self.t_start is None or self.t_end is None:
+			return 0.0
+		return self.t_end - self.t_start
+
+	def throughput (self) -> float:
+		wall = self.wall()
+		return self.nb_bytes / wall if wall > 0 else 0.0
+
+	def to_jobj (self) -> dict:
+		return {
+			"stage": self.stage,
+			"bytes": self.nb_bytes,
+			"wall": self.wall(),
+			"idle": self.idle,
+			"stall": self.stall,
+			"throughput": self.throughput()
+		}
+
+	def __str__ (self) -> str:
+		return "%s: %u bytes, %.3fs, %.2f MB/s, idle %.3fs, stall %.3fs" % (
+			self.stage,
+			self.nb_bytes,
+			self.wall(),
+			self.throughput() / 1000000,
+			self.idle,
+			self.stall)
+
+def meter_copy (ctx: GlobalContext, fd_in: int, fd_out: int, m: PipeMeter):
+	'''
+	Relay the pipe fd_in to the pipe fd_out until EOF, counting the time spent
+	waiting on either end.
+	'''
+	def wait (po: select.poll) -> float:
+		t = time.monotonic()
+		po.poll()
+		return time.monotonic() - t
+
+	po_in = select.poll()
+	po_in.register(fd_in, select.POLLIN)
+	po_out = select.poll()
+	po_out.register(fd_out, select.POLLOUT)
+	os.set_blocking(fd_in, False)
+	os.set_blocking(fd_out, False)
+	use_splice = hasattr(os, "splice")
+	pending = None
+
+	m.t_start = time.monotonic()
+	try:
+		while True:
+			if pending:
+				try:
+					n = os.write(fd_out, pending)
+					pending = pending[n:]
+					m.nb_bytes += n
+				except BlockingIOError:
+					m.stall += wait(po_out)
+				continue
+
+			try:
+				if use_splice:
+					n = os.splice(
+						fd_in,
+						fd_out,
+						ctx.child_io_size,
+						flags = os.SPLICE_F_MOVE | os.SPLICE_F_NONBLOCK)
+				else:
+					pending = memoryview(os.read(fd_in, ctx.child_io_size))
+					n = len(pending)
+					if n:
+						continue
+			except BlockingIOError:
+				# Find out which end would block
+				if po_in.poll(0):
+					m.stall += wait(po_out)
+				else:
+					m.idle += wait(po_in)
+				continue
+			except OSError as e:
+				if use_splice and e.errno in { errno.EINVAL, errno.ENOSYS }:
+					use_splice = False
+					continue
+				raise
+
+			if n == 0:
+				break
+			m.nb_bytes += n
+	except BrokenPipeError:
+		# The next stage exited prematurely. Its exit code will tell
+		pass
+	finally:
+		m.t_end = time.monotonic()
+
+class MeteredPipe:
+	'''
+	The in-process relay between two pipeline stages.
+	'''
+	def __init__ (self, ctx: GlobalContext, src, stage: str):
+		self.meter = PipeMeter(stage)
+		self.src = src
+		self.exc = None
+		fd_r, fd_w = os.pipe()
+		set_pipe_size(fd_w, ctx.pipe_size)
+		self.dst = os.fdopen(fd_w, "wb", 0)
+		self.stdout = os.fdopen(fd_r, "rb", 0)
+		self.th = threading.Thread(target = self._main, args = (ctx,))
+		self.th.start()
+
+	def _main (self, ctx: GlobalContext):
+		try:
+			meter_copy(ctx, self.src.fileno(), self.dst.fileno(), self.meter)
+		except BaseException as e:
+			self.exc = e
+		finally:
+			self.src.close()
+			self.dst.close()
+
+	def join (self):
+		self.th.join()
+		if self.exc is not None:
+			raise self.exc
+
+class ThrottledPipe:
+	'''
+	The in-process relay that limits the rate of the data flowing to the sink.
+	The tokens are taken from all the buckets so the lowest rate applies.
+	'''
+	def __init__ (self, ctx: GlobalContext, src, buckets: list[TokenBucket]):
+		self.src = src
+		self.buckets = buckets
+		self.exc = None
+		self.nb_bytes = 0
+		self.waited = 0.0
+		self.t_start = None
+		self.t_end = None
+		fd_r, fd_w = os.pipe()
+		set_pipe_size(fd_w, ctx.pipe_size)
+		self.dst = os.fdopen(fd_w, "wb", 0)
+		self.stdout = os.fdopen(fd_r, "rb", 0)
+		self.th = threading.Thread(target = self._main, args = (ctx,))
+		self.th.start()
+
+	def _main (self, ctx: GlobalContext):
+		# Don't go too deep into debt at low rates
+		size = int(min([ ctx.child_io_size ] + [ i.burst for i in self.buckets ]))
+		size = max(size, 1)
+		fd_in = self.src.fileno()
+		fd_out = self.dst.fileno()
+
+		self.t_start = time.monotonic()
+		try:
+			while True:
+				b = os.read(fd_in, size)
+				if not b:
+					break
+
+				wait = max(i.reserve(len(b)) for i in self.buckets)
+				if wait > 0:
+					time.sleep(wait)
+					self.waited += wait
+				write_fully(fd_out, b)
+				self.nb_bytes += len(b)
+		except BrokenPipeError:
+			# The sink exited prematurely. Its exit code will tell
+			pass
+		except BaseException as e:
+			self.exc = e
+		finally:
+			self.t_end = time.monotonic()
+			self.src.close()
+			self.dst.close()
+
+	def throughput (self) -> float:
+		wall = (self.t_end or 0) - (self.t_start or 0)
+		return self.nb_bytes / wall if wall > 0 else 0.0
+
+	def join (self):
+		self.th.join()
+		if self.exc is not None:
+			raise self.exc
+
+	def __str__ (self) -> str:
+		return "%u bytes, %.2f MB/s, throttled %.3fs" % (
+			self.nb_bytes,
+			self.throughput() / 1000000,
+			self.waited)
+
+class BuiltinFilter (ABC):
+	'''
+	The pipeline stage that runs in the PALHM process. Transforms the data
+	passing through without forking a child process.
+	'''
+	def __init__ (self, param: dict):
+		self.param = param
+		self.cost = ResourceBudget.parse_cost(param.get("cost", {}))
+
+	@abstractmethod
+	def start (self):
+		# Reset the state for a new run
+		...
+	@abstractmethod
+	def update (self, b) -> bytes:
+		...
+
+	def flush (self) -> bytes:
+		return b""
+
+	def result (self) -> str:
+		# The result of the run to be logged, if any
+		return None
+
+	def stop (self):
+		# Release the resources of the run. Called even if the run fails
+		pass
+
+	def __str__ (self) -> str:
+		return "builtin:%s %s" % (
+			self.NAME,
+			json.dumps(self.param, sort_keys = True))
+
+class DigestFilter (BuiltinFilter):
+	NAME = "digest"
+
+	def __init__ (self, param: dict):
+		super().__init__(param)
+		self.algo = param.get("algo", "sha256")
+		if not self.algo in hashlib.algorithms_available:
+			raise InvalidConfigError("Unsupported digest algorithm", self.algo)
+		self.h = None
+
+	def start (self):
+		self.h = hashlib.new(self.algo)
+
+	def update (self, b) -> bytes:
+		self.h.update(b)
+		return b
+
+	def result (self) -> str:
+		return "%s:%s" % (self.algo, self.h.hexdigest())
+
+class CountFilter (BuiltinFilter):
+	NAME = "count"
+
+	def start (self):
+		self.nb_bytes = 0
+
+	def update (self, b) -> bytes:
+		self.nb_bytes += len(b)
+		return b
+
+	def result (self) -> str:
+		return "%u bytes" % self.nb_bytes
+
+class CompressFilter (BuiltinFilter):
+	'''
+	With "threads" greater than 1, the input is split into blocks that are
+	compressed in parallel as independent gzip members, xz or bz2 streams like
+	pigz does. The decompressors take the concatenated members as one stream.
+	The codecs release the GIL so the blocks are compressed on threads.
+	'''
+	NAME = "compress"
+
+	def __init__ (self, param: dict):
+		super().__init__(param)
+		self.format = param.get("format", "gzip")
+		self.level = param.get("level")
+		self.threads = int(param.get("threads", 0))
+		if self.threads < 0:
+			self.threads = os.cpu_count() or 1
+		self.block_size = int(param.get(
+			"block-size",
+			DEFAULT.COMPRESS_BLOCK_SIZE.value))
+		self.c = None
+		self.th_pool = None
+		self.buf = bytearray()
+		self.fl = deque[Future]()
+
+		if self.format == "zstd":
+			try:
+				import zstandard
+			except ImportError as e:
+				raise InvalidConfigError(
+					"zstd requires the 'zstandard' module") from e
+		elif not self.format in { "gzip", "xz", "bz2" }:
+			raise InvalidConfigError("Unsupported format", self.format)
+		if self.block_size <= 0:
+			raise InvalidConfigError("Invalid 'block-size'", self.block_size)
+
+	def _mkcompressor (self):
+		if self.format == "gzip":
+			return zlib.compressobj(
+				-1 if self.level is None else self.level,
+				zlib.DEFLATED,
+				31) # gzip header
+		elif self.format == "xz":
+			return lzma.LZMACompressor(preset = self.level)
+		elif self.format == "bz2":
+			return bz2.BZ2Compressor(9 if self.level is None else self.level)
+		else:
+			import zstandard
+			return zstandard.ZstdCompressor(
+				level = 3 if self.level is None else self.level,
+				threads = self.threads).compressobj()
+
+	def _compress_block (self, b: bytes) -> bytes:
+		c = self._mkcompressor()
+		return c.compress(b) + c.flush()
+
+	def start (self):
+		self.buf = bytearray()
+		self.fl.clear()
+		if self.threads > 1 and self.format != "zstd":
+			self.th_pool = ThreadPoolExecutor(
+				max_workers = self.threads,
+				thread_name_prefix = "compress")
+		else:
+			self.c = self._mkcompressor()
+
+	def _submit (self, b: bytes):
+		self.fl.append(self.th_pool.submit(self._compress_block, b))
+
+	def _collect (self, wait: bool) -> bytes:
+		# The blocks are written in order. Keep 2 blocks per thread in flight
+		ret = list[bytes]()
+		while self.fl and (
+				self.fl[0].done() or
+				wait or
+				len(self.fl) >= self.threads * 2):
+			ret.append(self.fl.popleft().result())
+		return b"".join(ret)
+
+	def update (self, b) -> bytes:
+		if self.th_pool is None:
+			return self.c.compress(b)
+
+		self.buf += b
+		while len(self.buf) >= self.block_size:
+			self._submit(bytes(self.buf[:self.block_size]))
+			del self.buf[:self.block_size]
+		return self._collect(False)
+
+	def flush (self) -> bytes:
+		if self.th_pool is None:
+			return self.c.flush()
+
+		if self.buf or not self.fl:
+			# An empty input still makes a valid stream
+			self._submit(bytes(self.buf))
+			self.buf = bytearray()
+		ret = self._collect(True)
+		self.stop()
+		return ret
+
+	def stop (self):
+		if self.th_pool is not None:
+			self.th_pool.shutdown(cancel_futures = True)
+			self.th_pool = None
+			self.fl.clear()
+
+BuiltinFilterMap = {
+	"digest": DigestFilter,
+	"count": CountFilter,
+	"compress": CompressFilter
+}
+
+class FilterPipe:
+	'''
+	Runs the consecutive builtin stages, each on its own thread. The stages
+	are connected by bounded queues so that the data is passed between them
+	without a pipe or a copy. The compression and hashing functions release
+	the GIL so the stages run on multiple cores.
+	'''
+	EOF = object()
+
+	def __init__ (self, ctx: GlobalContext, src, filters: list[BuiltinFilter]):
+		self.src = src
+		self.filters = filters
+		self.exc = None
+		self.failed = threading.Event()
+		fd_r, fd_w = os.pipe()
+		set_pipe_size(fd_w, ctx.pipe_size)
+		self.dst = os.fdopen(fd_w, "wb", 0)
+		self.stdout = os.fdopen(fd_r, "rb", 0)
+		self.queues = [
+			Queue(DEFAULT.FILTER_BUFS.value) for i in range(len(filters) + 1) ]
+		self.threads = [
+			threading.Thread(
+				target = self._stage_main,
+				args = (i, ),
+				name = "filter: " + f.NAME)
+				for i, f in enumerate(filters) ]
+		self.threads.append(threading.Thread(
+			target = self._write_main,
+			name = "filter: write"))
+		self.th = threading.Thread(target = self._main, args = (ctx,))
+		self.th.start()
+
+	def _fail (self, e: BaseException):
+		if self.exc is None:
+			self.exc = e
+		self.failed.set()
+
+	def _put (self, i: int, b):
+		# Give up if the stages downstream have failed
+		while not self.failed.is_set():
+			try:
+				self.queues[i].put(b, timeout = 0.1)
+				return
+			except queue.Full:
+				pass
+		raise BrokenPipeError()
+
+	def _get (self, i: int):
+		while not self.failed.is_set():
+			try:
+				return self.queues[i].get(timeout = 0.1)
+			except queue.Empty:
+				pass
+		raise BrokenPipeError()
+
+	def _stage_main (self, i: int):
+		f = self.filters[i]
+
+		try:
+			while True:
+				b = self._get(i)
+				if b is FilterPipe.EOF:
+					break
+				b = f.update(b)
+				if b:
+					self._put(i + 1, b)
+
+			b = f.flush()
+			if b:
+				self._put(i + 1, b)
+			self._put(i + 1, FilterPipe.EOF)
+		except BrokenPipeError:
+			self.failed.set()
+		except BaseException as e:
+			self._fail(e)
+		finally:
+			f.stop()
+
+	def _write_main (self):
+		fd_out = self.dst.fileno()
+
+		try:
+			while True:
+				b = self._get(len(self.filters))
+				if b is FilterPipe.EOF:
+					break
+				write_fully(fd_out, b)
+		except BrokenPipeError:
+			# The next stage exited prematurely. Its exit code will tell
+			self.failed.set()
+		except BaseException as e:
+			self._fail(e)
+		finally:
+			self.dst.close()
+
+	def _main (self, ctx: GlobalContext):
+		started = list[threading.Thread]()
+
+		try:
+			for f in self.filters:
+				f.start()
+			for th in self.threads:
+				th.start()
+				started.append(th)
+
+			while self.src is not None:
+				b = os.read(self.src.fileno(), ctx.child_io_size)
+				if not b:
+					break
+				self._put(0, b)
+			self._put(0, FilterPipe.EOF)
+		except BrokenPipeError:
+			pass
+		except BaseException as e:
+			self._fail(e)
+		finally:
+			if self.src is not None:
+				self.src.close()
+			for th in started:
+				th.join()
+			if len(started) < len(self.threads):
+				for f in self.filters:
+					f.stop()
+				self.dst.close()
+
+	def join (self):
+		self.th.join()
+		if self.exc is not None:
+			raise self.exc
+
+class NativeSink (ABC):
+	'''
+	The sink that consumes the output of the pipeline in the PALHM process
+	rather than in a child process.
+	'''
+	@abstractmethod
+	def write (self, ctx: GlobalContext, b) -> int:
+		...
+	@abstractmethod
+	def close (self, ctx: GlobalContext):
+		...
+
+	def abort (self, ctx: GlobalContext):
+		self.close(ctx)
+
+	def drain (self, ctx: GlobalContext, fd: int) -> int:
+		ret = 0
+
+		while True:
+			b = os.read(fd, ctx.child_io_size)
+			if not b:
+				break
+			ret += self.write(ctx, b)
+
+		return ret
+
+	def feed (self, ctx: GlobalContext, fd: int) -> int:
+		'''
+		Move the data available in fd to the sink. Return 0 on EOF.
+		'''
+		b = os.read(fd, ctx.child_io_size)
+		return self.write(ctx, b) if b else 0
+
+	def poll_fd (self) -> int:
+		'''
+		The fd to poll for POLLOUT when write_some() can't take more data or
+		None if the sink does not write to a pipe.
+		'''
+		return None
+
+	def write_some (self, ctx: GlobalContext, b) -> int:
+		'''
+		Write as much of b as possible without blocking. Only used if
+		poll_fd() returns an fd.
+		'''
+		return self.write(ctx, b)
+
+class FileSink (NativeSink):
+	def __init__ (self, path: str, mode: int, alloc_size: int = None):
+		self.path = path
+		self.fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, mode)
+		self.size = 0
+		self.use_splice = hasattr(os, "splice")
+		self.preallocd = (
+			alloc_size is not None and preallocate(self.fd, alloc_size))
+
+	def write (self, ctx: GlobalContext, b) -> int:
+		n = write_fully(self.fd, b)
+		self.size += n
+		return n
+
+	def drain (self, ctx: GlobalContext, fd: int) -> int:
+		n = pipe_copy(ctx, fd, self.fd)
+		self.size += n
+		return n
+
+	def feed (self, ctx: GlobalContext, fd: int) -> int:
+		if not self.use_splice:
+			return super().feed(ctx, fd)
+
+		try:
+			n = os.splice(fd, self.fd, ctx.child_io_size, flags = os.SPLICE_F_MOVE)
+		except OSError as e:
+			if e.errno in { errno.EINVAL, errno.ENOSYS, errno.EOPNOTSUPP }:
+				self.use_splice = False
+				return super().feed(ctx, fd)
+			raise
+		self.size += n
+		return n
+
+	def close (self, ctx: GlobalContext):
+		if self.fd is not None:
+			fd = self.fd
+			self.fd = None
+			try:
+				if self.preallocd:
+					# Cut off the space reserved but not written
+					os.ftruncate(fd, self.size)
+			finally:
+				os.close(fd)
+
+	def __str__ (self) -> str:
+		return "native > " + self.path
+
+class ExecSink (NativeSink):
+	'''
+	Feeds the Exec sink of a backend through a pipe.
+	'''
+	def __init__ (self, ctx: GlobalContext, eh: Exec, tag: str = None):
+		self.eh = eh
+		self.outputs = eh.capture(ctx, tag)
+		self.p = popen_captured(
+			self.outputs,
+			args = eh.argv,
+			stdin = subprocess.PIPE,
+			stdout = self.outputs[0].fd,
+			stderr = self.outputs[1].fd,
+			env = eh.env)
+		set_pipe_size(self.p.stdin.fileno(), ctx.pipe_size)
+
+	def write (self, ctx: GlobalContext, b) -> int:
+		return write_fully(self.p.stdin.fileno(), b)
+
+	def poll_fd (self) -> int:
+		return self.p.stdin.fileno()
+
+	def write_some (self, ctx: GlobalContext, b) -> int:
+		# The sink is written using either write() or write_some()
+		fd = self.p.stdin.fileno()
+		os.set_blocking(fd, False)
+		try:
+			return os.write(fd, b)
+		except BlockingIOError:
+			return 0
+
+	def close (self, ctx: GlobalContext):
+		self.p.stdin.close()
+		self.eh.raise_oob_ec(self.p.wait(), self.outputs)
+
+	def abort (self, ctx: GlobalContext):
+		self.p.stdin.close()
+		self.p.wait()
+
+	def __str__ (self) -> str:
+		return str(self.eh)
+
+class TeeSink (NativeSink):
+	'''
+	Copies the output of the pipeline to multiple sinks. Each sink is fed from
+	its own thread through a bounded queue so that the slowest sink paces the
+	pipeline.
+	'''
+	ABORT = object()
+
+	def __init__ (self, ctx: GlobalContext, sinks: list[NativeSink]):
+		self.sinks = sinks
+		self.excs = [ None ] * len(sinks)
+		self.queues = list[Queue]()
+		self.threads = list[threading.Thread]()
+
+		for i, sink in enumerate(sinks):
+			q = Queue(DEFAULT.TEE_BUFS.value)
+			th = threading.Thread(
+				target = self._branch_main,
+				args = (ctx, i, sink, q),
+				name = "tee: " + str(sink))
+			self.queues.append(q)
+			self.threads.append(th)
+			th.start()
+
+	def _branch_main (self, ctx: GlobalContext, i: int, sink: NativeSink, q: Queue):
+		b = None
+		try:
+			while True:
+				b = q.get()
+				if b is None or b is TeeSink.ABORT:
+					break
+				sink.write(ctx, b)
+		except BaseException as e:
+			self.excs[i] = e
+			# Keep consuming so that the writer does not block
+			while b is not None and b is not TeeSink.ABORT:
+				b = q.get()
+			b = TeeSink.ABORT
+
+		try:
+			if b is None:
+				sink.close(ctx)
+			else:
+				sink.abort(ctx)
+		except BaseException as e:
+			self.excs[i] = self.excs[i] or e
+
+	def _raise (self):
+		for e in self.excs:
+			if e is not None:
+				raise e
+
+	def write (self, ctx: GlobalContext, b) -> int:
+		self._raise()
+		b = bytes(b)
+		for q in self.queues:
+			q.put(b)
+
+		return len(b)
+
+	def _join (self, x):
+		for q in self.queues:
+			q.put(x)
+		for th in self.threads:
+			th.join()
+
+	def close (self, ctx: GlobalContext):
+		self._join(None)
+		self._raise()
+
+	def abort (self, ctx: GlobalContext):
+		self._join(TeeSink.ABORT)
+
+	def __str__ (self) -> str:
+		return "tee > " + ", ".join(str(i) for i in self.sinks)
+
+class ThrottledSink (NativeSink):
+	'''
+	Limits the rate of the data written to the sink of a backend. Applied on
+	the branch of the backend so that the limit of a backend does not apply
+	to the others.
+	'''
+	def wrap (
+			ctx: GlobalContext,
+			sink: Union[Exec, NativeSink],
+			bucket: TokenBucket,
+			tag: str) -> Union[Exec, NativeSink]:
+		if bucket is None:
+			return sink
+		if not isinstance(sink, NativeSink):
+			sink = ExecSink(ctx, sink, tag)
+		return ThrottledSink(sink, bucket)
+
+	def __init__ (self, sink: NativeSink, bucket: TokenBucket):
+		self.sink = sink
+		self.bucket = bucket
+		self.waited = 0.0
+
+	def write (self, ctx: GlobalContext, b) -> int:
+		wait = self.bucket.reserve(len(b))
+		if wait > 0:
+			time.sleep(wait)
+			self.waited += wait
+		return self.sink.write(ctx, b)
+
+	def close (self, ctx: GlobalContext):
+		self.sink.close(ctx)
+
+	def abort (self, ctx: GlobalContext):
+		self.sink.abort(ctx)
+
+	def __str__ (self) -> str:
+		return str(self.sink)
+
+class DigestSink (NativeSink):
+	'''
+	Hashes the output of the pipeline on its way to the sink. The digest is
+	set to the backup object on close.
+	'''
+	def __init__ (self, sink: NativeSink, bo):
+		self.sink = sink
+		self.bo = bo
+		self.h = hashlib.new(bo.checksum)
+
+	def write (self, ctx: GlobalContext, b) -> int:
+		self.h.update(b)
+		return self.sink.write(ctx, b)
+
+	def poll_fd (self) -> int:
+		return self.sink.poll_fd()
+
+	def write_some (self, ctx: GlobalContext, b) -> int:
+		n = self.sink.write_some(ctx, b)
+		self.h.update(b[:n])
+		return n
+
+	def close (self, ctx: GlobalContext):
+		self.bo.digest = "%s:%s" % (self.bo.checksum, self.h.hexdigest())
+		self.sink.close(ctx)
+
+	def abort (self, ctx: GlobalContext):
+		self.sink.abort(ctx)
+
+	def __str__ (self) -> str:
+		return str(self.sink)
+
+def hash_file (path: str, h, bufsize: int = DEFAULT.VERIFY_BUF_SIZE.value) -> int:
+	'''
+	Feed the contents of the file to the hash object using mmap. The pages are
+	dropped from the page cache as they are hashed so that the working set of
+	the host is not evicted.
+	'''
+	fd = os.open(path, os.O_RDONLY)
+	try:
+		size = os.fstat(fd).st_size
+		if size == 0:
+			return 0
+		os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_SEQUENTIAL)
+
+		with mmap.mmap(fd, size, prot = mmap.PROT_READ) as mm:
+			mm.madvise(mmap.MADV_SEQUENTIAL)
+			mv = memoryview(mm)
+			try:
+				for off in range(0, size, bufsize):
+					h.update(mv[off:off + bufsize])
+					l = min(bufsize, size - off)
+					mm.madvise(mmap.MADV_DONTNEED, off, l)
+					os.posix_fadvise(fd, off, l, os.POSIX_FADV_DONTNEED)
+			finally:
+				mv.release()
+	finally:
+		os.close(fd)
+
+	return size
+
+class VerifyResult:
+	'''
+	The result of verifying a backup object against the manifest.
+	'''
+	def __init__ (self, copy: str, path: str, ent: dict = None):
+		self.copy = copy
+		self.path = path
+		self.size = ent.get("size") if ent else None
+		self.expected = ent.get("digest") if ent else None
+		self.actual = None
+		self.nb_bytes = 0
+		self.error = None
+		self.elapsed = 0.0
+
+	def run (self, f, *args):
+		'''
+		Calculate the digest of the object using f(h, *args) -> bytes read.
+		The object is not read if the manifest has no digest of it.
+		'''
+		if self.expected is None:
+			return self
+
+		t = time.monotonic()
+		try:
+			algo = self.expected.split(":", 1)[0]
+			h = hashlib.new(algo)
+			self.nb_bytes = f(h, *args)
+			self.actual = "%s:%s" % (algo, h.hexdigest())
+		except Exception as e:
+			self.error = repr(e)
+		self.elapsed = time.monotonic() - t
+
+		return self
+
+	def ok (self) -> bool:
+		return (self.error is None and
+			self.expected is not None and
+			self.expected == self.actual and
+			self.size == self.nb_bytes)
+
+	def status (self) -> str:
+		if self.error is not None:
+			return "ERROR"
+		if self.expected is None:
+			return "NO-CHECKSUM"
+		return "OK" if self.ok() else "MISMATCH"
+
+	def __str__ (self) -> str:
+		ret = "%-11s %9.2f MB/s %s/%s" % (
+			self.status(),
+			self.nb_bytes / self.elapsed / 1000000 if self.elapsed else 0.0,
+			self.copy,
+			self.path)
+		if self.error is not None:
+			ret += ": " + self.error
+		elif self.expected is not None and not self.ok():
+			ret += ": expected %s(%s bytes), got %s(%u bytes)" % (
+				self.expected,
+				self.size,
+				self.actual,
+				self.nb_bytes)
+		return ret
+
+class BackupManifest:
+	'''
+	The index of a backup copy. Holds the attributes of the objects in the
+	copy.
+	'''
+	NAME = ".palhm-manifest.json"
+	VERSION = 1
+
+	def __init__ (self):
+		self.objects = dict[str, dict]()
+
+	def add (self, path: str, size: int, bo = None) -> dict:
+		ret = self.objects[path] = { "size": size }
+		if bo is not None:
+			if bo.fp is not None:
+				ret["fingerprint"] = bo.fp
+			if bo.digest is not None:
+				ret["digest"] = bo.digest
+		return ret
+
+	def total (self) -> int:
+		return sum(i["size"] for i in self.objects.values())
+
+	def to_jobj (self) -> dict:
+		return {
+			"version": BackupManifest.VERSION,
+			"total": self.total(),
+			"objects": self.objects
+		}
+
+	def dumps (self) -> str:
+		return json.dumps(self.to_jobj(), indent = "\t", sort_keys = True)
+
+	def loads (x: str):
+		jobj = json.loads(x)
+		if jobj.get("version") != BackupManifest.VERSION:
+			raise ValueError("Unsupported manifest version", jobj.get("version"))
+
+		ret = BackupManifest()
+		ret.objects = jobj["objects"]
+		return ret
+
 class BackupBackend (ABC):
 	@contextmanager
 	def open (self, ctx: GlobalContext):
@@ -419,7 +2081,7 @@ class BackupBackend (ABC):
 	def close (self, ctx: GlobalContext):
 		...
 	@abstractmethod
-	def sink (self, ctx: GlobalContext, bo) -> Exec:
+	def sink (self, ctx: GlobalContext, bo) -> Union[Exec, NativeSink]:
 		...
 	@abstractmethod
 	def rotate (self, ctx: GlobalContext):
@@ -439,6 +2101,31 @@ class BackupBackend (ABC):
 		name = "bb." + str(self)
 		return ctx.l.getChild(name)
 
+	def rebuild_index (self, ctx: GlobalContext):
+		# For the backends that keep the index of the backup copies
+		pass
+
+	def reuse (self, ctx: GlobalContext, bo) -> bool:
+		'''
+		Put the object from the previous copy in the current copy if its
+		fingerprint matches bo.fp. Return False if the object has to be made.
+		'''
+		return False
+
+	def copies (self, ctx: GlobalContext) -> list[str]:
+		# The names of the backup copies, oldest first
+		raise NotImplementedError("Not supported by the backend", str(self))
+
+	def verify (
+			self,
+			ctx: GlobalContext,
+			copies: Iterable[str]) -> Iterable[VerifyResult]:
+		'''
+		Verify the objects in the copies against the checksums in the
+		manifests. Yield the results as they complete.
+		'''
+		raise NotImplementedError("Not supported by the backend", str(self))
+
 	@abstractmethod
 	def _fs_quota_target (self, ctx: GlobalContext) -> tuple[Decimal, Decimal]:
 		# return: nb_copies, tot_size
@@ -529,8 +2216,15 @@ class LocalfsBackupBackend (BackupBackend):
 		self.block_size = param.get("block-size", _getpagesize())
 		self.dmode = int(param.get("dmode", "750"), 8)
 		self.fmode = int(param.get("fmode", "640"), 8)
+		self.sink_type = param.get("sink", "native")
 		self.cur_backup_path = None
 		self.sink_list = list[str]()
+		self.sink_objs = dict[str, object]()
+		self.lock = threading.Lock()
+		self.prev_copy = None
+
+		if not self.sink_type in { "native", "dd" }:
+			raise InvalidConfigError("Invalid 'sink'", self.sink_type)
 
 	def open (self, ctx: GlobalContext):
 		self.cur_backup_path = os.sep.join([ self.backup_root, self.mkprefix() ])
@@ -544,33 +2238,171 @@ class LocalfsBackupBackend (BackupBackend):
 	def close (self, ctx: GlobalContext):
 		pass
 
-	def sink (self, ctx: GlobalContext, bo) -> Exec:
+	def sink (self, ctx: GlobalContext, bo) -> Union[Exec, NativeSink]:
 		path = os.sep.join([ self.cur_backup_path, bo.path ])
 		os.makedirs(os.path.dirname(path), self.dmode, True)
 		self.sink_list.append(path)
+		self.sink_objs[path] = bo
+
+		if self.sink_type == "native":
+			return FileSink(path, self.fmode, bo.alloc_size)
 
 		if bo.alloc_size is not None:
-			try: os.truncate(bo.path, bo.alloc_size)
-			except: pass
+			try: os.truncate(path, bo.alloc_size)
+			except OSError: pass
 
 		e = Exec()
 		e.argv = [ "/bin/dd", "bs=" + str(self.block_size), "of=" + path ]
 
 		return e
 
+	def _write_manifest (self, path: str, m: BackupManifest):
+		mpath = os.sep.join([ path, BackupManifest.NAME ])
+		tmp = mpath + ".tmp"
+
+		with open(os.open(
+			tmp,
+			os.O_WRONLY | os.O_CREAT | os.O_TRUNC,
+			self.fmode), "w") as f:
+			f.write(m.dumps())
+		os.replace(tmp, mpath)
+
+	def _read_manifest (self, path: str) -> BackupManifest:
+		try:
+			with open(os.sep.join([ path, BackupManifest.NAME ])) as f:
+				return BackupManifest.loads(f.read())
+		except FileNotFoundError:
+			return None
+
+	def _mk_manifest (self, path: str) -> BackupManifest:
+		ret = BackupManifest()
+
+		for root, dirs, files in os.walk(path):
+			for f in files:
+				p = os.path.join(root, f)
+				if os.path.islink(p) or p == os.path.join(path, BackupManifest.NAME):
+					continue
+				ret.add(os.path.relpath(p, path), os.path.getsize(p))
+
+		return ret
+
+	def _copy_dirs (self) -> list[os.DirEntry]:
+		ret = LocalfsBackupBackend.get_dirs(self.backup_root)
+		ret.sort(key = lambda x: x.name)
+		return ret
+
+	def _prev_copy (self) -> tuple[str, BackupManifest]:
+		with self.lock:
+			if self.prev_copy is None:
+				cur = os.path.basename(self.cur_backup_path)
+				dirs = [ i for i in self._copy_dirs() if i.name < cur ]
+				if dirs:
+					self.prev_copy = (dirs[-1].path, self._read_manifest(dirs[-1].path))
+				else:
+					self.prev_copy = (None, None)
+			return self.prev_copy
+
+	def _prev_object (self, bo) -> tuple[str, dict]:
+		path, m = self._prev_copy()
+		if m is None:
+			return (None, None)
+
+		ent = m.objects.get(bo.path)
+		if (ent is None or
+			ent.get("fingerprint") != bo.fp or
+			not bo.test_digest(ent.get("digest"))):
+			return (None, None)
+		return (path, ent)
+
+	def reuse (self, ctx: GlobalContext, bo) -> bool:
+		prev, ent = self._prev_object(bo)
+		if prev is None:
+			return False
+
+		src = os.sep.join([ prev, bo.path ])
+		dst = os.sep.join([ self.cur_backup_path, bo.path ])
+		os.makedirs(os.path.dirname(dst), self.dmode, True)
+		try:
+			os.link(src, dst)
+		except FileNotFoundError:
+			return False
+		except OSError:
+			file_copy(src, dst, self.fmode)
+
+		self._logger(ctx).debug("reuse: %s -> %s" % (src, dst))
+		bo.digest = ent.get("digest")
+		self.sink_list.append(dst)
+		self.sink_objs[dst] = bo
+
+		return True
+
+	def copies (self, ctx: GlobalContext) -> list[str]:
+		return [ i.name for i in self._copy_dirs() ]
+
+	def _hash_obj (self, h, copy_path: str, path: str, ent: dict) -> int:
+		return hash_file(os.sep.join([ copy_path, path ]), h)
+
+	def verify (
+			self,
+			ctx: GlobalContext,
+			copies: Iterable[str]) -> Iterable[VerifyResult]:
+		with ThreadPoolExecutor(max_workers = ctx.nb_workers) as th_pool:
+			fl = list[Future]()
+
+			for copy in copies:
+				copy_path = os.sep.join([ self.backup_root, copy ])
+				m = self._read_manifest(copy_path)
+				if m is None:
+					r = VerifyResult(copy, BackupManifest.NAME)
+					r.error = "no manifest"
+					yield r
+					continue
+
+				for path, ent in sorted(m.objects.items()):
+					r = VerifyResult(copy, path, ent)
+					if r.expected is None:
+						yield r
+						continue
+					fl.append(th_pool.submit(
+						r.run,
+						self._hash_obj,
+						copy_path,
+						path,
+						ent))
+
+			for f in futures.as_completed(fl):
+				yield f.result()
+
+	def _copy_usage (self, ctx: GlobalContext, path: str) -> int:
+		l = self._logger(ctx)
+		m = self._read_manifest(path)
+
+		if m is None:
+			l.debug("no manifest. Walking: " + path)
+			m = self._mk_manifest(path)
+			try:
+				self._write_manifest(path, m)
+			except OSError as e:
+				l.warning("failed to write manifest: " + str(e))
+
+		return m.total()
+
 	def _fs_usage_info (self, ctx: GlobalContext) -> Iterable[tuple[str, int]]:
-		def get_name (entry: os.DirEntry) -> str:
-			return entry.name
 		ret = list[tuple[str, int]]()
-		dirs = LocalfsBackupBackend.get_dirs(self.backup_root)
 
-		dirs.sort(key = get_name)
-		for i in dirs:
-			e = (i.path, LocalfsBackupBackend.du(i.path))
+		for i in self._copy_dirs():
+			e = (i.path, self._copy_usage(ctx, i.path))
 			ret.append(e)
 
 		return ret
 
+	def rebuild_index (self, ctx: GlobalContext):
+		l = self._logger(ctx)
+
+		for i in self._copy_dirs():
+			l.info("reindex: " + i.path)
+			self._write_manifest(i.path, self._mk_manifest(i.path))
+
 	def _rm_fs_recursive (self, ctx: GlobalContext, pl: Iterable[str]):
 		l = self._logger(ctx)
 
@@ -587,8 +2419,16 @@ class LocalfsBackupBackend (BackupBackend):
 		return ret
 
 	def rotate (self, ctx: GlobalContext):
+		m = BackupManifest()
+
 		for i in self.sink_list:
 			os.chmod(i, self.fmode)
+			m.add(
+				os.path.relpath(i, self.cur_backup_path),
+				os.path.getsize(i),
+				self.sink_objs[i])
+		self._write_manifest(self.cur_backup_path, m)
+
 		return super()._do_fs_rotate(ctx)
 
 	def __str__ (self):
@@ -597,12 +2437,14 @@ class LocalfsBackupBackend (BackupBackend):
 	nb_copy_limit: {nb_copy_limit}
 	root_size_limit: {root_size_limit}
 	dmode: {dmode:o}
-	fmode: {fmode:o}'''.format(
+	fmode: {fmode:o}
+	sink: {sink}'''.format(
 		root = self.backup_root,
 		nb_copy_limit = self.nb_copy_limit,
 		root_size_limit = self.root_size_limit,
 		dmode = self.dmode,
-		fmode = self.fmode)
+		fmode = self.fmode,
+		sink = self.sink_type)
 
 	def du (path: str) -> int:
 		ret = 0
@@ -623,7 +2465,178 @@ class LocalfsBackupBackend (BackupBackend):
 
 		return ret
 
+class MultiBackupBackend (BackupBackend):
+	'''
+	Writes the backup objects to multiple backends in a single pass. The
+	backends are rotated and rolled back on their own.
+	'''
+	def __init__ (self, bbs: list[BackupBackend], buckets: list[TokenBucket]):
+		self.bbs = bbs
+		# The limits of the backends. None if not limited
+		self.buckets = buckets
+		self.reused = dict[str, set[int]]()
+
+	@contextmanager
+	def open (self, ctx: GlobalContext):
+		cms = list()
+
+		try:
+			for bb in self.bbs:
+				cm = bb.open(ctx)
+				cm.__enter__()
+				cms.append(cm)
+			yield self
+		except:
+			exc = sys.exc_info()
+			for cm in cms:
+				try: cm.__exit__(*exc)
+				except: pass
+			raise
+
+		# Rotate the rest even if one of them fails
+		exc = None
+		for cm in cms:
+			try:
+				cm.__exit__(None, None, None)
+			except Exception as e:
+				self._logger(ctx).error("rotate failed: " + repr(e))
+				exc = exc or e
+		if exc is not None:
+			raise exc
+
+	def rollback (self, ctx: GlobalContext):
+		pass
+
+	def close (self, ctx: GlobalContext):
+		pass
+
+	def reuse (self, ctx: GlobalContext, bo) -> bool:
+		done = set[int]()
+		for i, bb in enumerate(self.bbs):
+			if bb.reuse(ctx, bo):
+				done.add(i)
+		self.reused[bo.path] = done
+
+		return len(done) == len(self.bbs)
+
+	def sink (self, ctx: GlobalContext, bo) -> Union[Exec, NativeSink]:
+		# Only to the backends that have not reused the object
+		done = self.reused.get(bo.path, set[int]())
+		sinks = [
+			ThrottledSink.wrap(ctx, bb.sink(ctx, bo), self.buckets[i], bo.path)
+				for i, bb in enumerate(self.bbs) if not i in done
+		]
+
+		if len(sinks) == 1:
+			return sinks[0]
+		return TeeSink(
+			ctx,
+			[ i if isinstance(i, NativeSink) else ExecSink(ctx, i, bo.path) for i in sinks ])
+
+	def rebuild_index (self, ctx: GlobalContext):
+		for bb in self.bbs:
+			bb.rebuild_index(ctx)
+
+	def rotate (self, ctx: GlobalContext):
+		pass
+
+	def _fs_usage_info (self, ctx: GlobalContext) -> Iterable[tuple[str, int]]:
+		return iter(())
+
+	def _excl_fs_copies (self, ctx: GlobalContext) -> set[str]:
+		return set[str]()
+
+	def _rm_fs_recursive (self, ctx: GlobalContext, pl: Iterable[str]):
+		pass
+
+	def _fs_quota_target (self, ctx: GlobalContext) -> tuple[Decimal, Decimal]:
+		return (Decimal('inf'), Decimal('inf'))
+
+	def __str__ (self):
+		return "multi:\n\t" + "\n".join(str(i) for i in self.bbs).replace("\n", "\n\t")
+
+class DeliveryResult:
+	def __init__ (self, recipient: str):
+		self.recipient = recipient
+		self.attempts = 0
+		self.elapsed = 0.0
+		self.error = None
+
+	def ok (self) -> bool:
+		return self.error is None
+
+	def __str__ (self) -> str:
+		return "%s %s: %d attempt(s) in %.3fs%s" % (
+			"OK" if self.ok() else "FAIL",
+			self.recipient,
+			self.attempts,
+			self.elapsed,
+			"" if self.ok() else ": " + repr(self.error))
+
 class MUA (ABC):
+	'''
+	The mail user agent front-end. The MUAs that deliver the message to each
+	recipient separately can use deliver() to fan out the deliveries.
+	'''
+	def __init__ (self, jobj: dict):
+		self.concurrency = int(jobj.get("concurrency", 4))
+		self.retries = int(jobj.get("retries", 2))
+		self.backoff = float(jobj.get("backoff", 1.0))
+
+		if self.concurrency <= 0:
+			raise InvalidConfigError("Invalid 'concurrency'", self.concurrency)
+		if self.retries < 0:
+			raise InvalidConfigError("Invalid 'retries'", self.retries)
+		if not math.isfinite(self.backoff) or self.backoff < 0:
+			raise InvalidConfigError("Invalid 'backoff'", self.backoff)
+
+	def _deliver_one (self, recipient: str, f) -> DeliveryResult:
+		ret = DeliveryResult(recipient)
+		t = time.monotonic()
+
+		while True:
+			ret.attempts += 1
+			try:
+				f(recipient)
+				ret.error = None
+				break
+			except Exception as e:
+				ret.error = e
+				if ret.attempts > self.retries:
+					break
+			# Full jitter
+			time.sleep(random.uniform(0, self.backoff * 2 ** (ret.attempts - 1)))
+
+		ret.elapsed = time.monotonic() - t
+		return ret
+
+	def deliver (
+			self,
+			ctx: GlobalContext,
+			recipients: Iterable[str],
+			f) -> list[DeliveryResult]:
+		'''
+		Call f(recipient) for each recipient concurrently. Failed deliveries
+		are retried with exponential backoff.
+		'''
+		l = ctx.l.getChild(self.__class__.__name__)
+		recipients = list(recipients)
+		if not recipients:
+			return []
+
+		with ThreadPoolExecutor(min(self.concurrency, len(recipients))) as th_pool:
+			ret = list(th_pool.map(
+				lambda r: self._deliver_one(r, f),
+				recipients))
+
+		for i in ret:
+			if i.ok():
+				l.info(str(i))
+			else:
+				l.error(str(i))
+
+		return ret
+
 	@abstractmethod
 	def do_send (
 		self,
@@ -634,12 +2647,18 @@ class MUA (ABC):
 
 class MailxMUA (MUA):
 	def __init__ (self, jobj: dict):
+		super().__init__(jobj)
 		self.exec = jobj.get("exec", "/bin/mailx")
 		self.int_opts = jobj.get("int-opts", [])
 
 	def __str__ (self) -> str:
 		return '''mailx:
-	exec: {exec}'''.format(exec = self.exec)
+	exec: {exec}
+	concurrency: {concurrency}
+	retries: {retries}'''.format(
+		exec = self.exec,
+		concurrency = self.concurrency,
+		retries = self.retries)
 
 	def do_send (
 		self,
@@ -652,18 +2671,22 @@ class MailxMUA (MUA):
 			argv.append("-S")
 			argv.append(i)
 		argv += [ "-s", subject ]
-		argv += recipients
-
-		with subprocess.Popen(
-			argv,
-			stdin = subprocess.PIPE,
-			stdout = subprocess.DEVNULL,
-			stderr = subprocess.PIPE) as p:
-			for d in composer:
-				p.stdin.write(d.encode())
-			p.stdin.close()
+		body = "".join(composer).encode()
 
-			return p.wait()
+		def send (r: str):
+			with subprocess.Popen(
+				argv + [ r ],
+				stdin = subprocess.PIPE,
+				stdout = subprocess.DEVNULL,
+				stderr = subprocess.PIPE) as p:
+				_, err = p.communicate(body)
+				if p.returncode != 0:
+					raise ChildProcessError(
+						p.returncode,
+						err.decode(errors = "replace").strip())
+
+		results = self.deliver(ctx, recipients, send)
+		return 0 if all(i.ok() for i in results) else 1
 
 class StdoutMUA (MUA):
 	def __init__ (self, jobj: dict): pass
@@ -737,12 +2760,28 @@ BuiltinRunMap = {
 class Task (Runnable):
 	...
 
+class RoutineStep:
+	def __init__ (self, idx: int, jobj: dict, r: Runnable):
+		self.id = jobj.get("id", "#" + str(idx))
+		self.depends = list[str](jobj.get("depends", iter(())))
+		self.r = r
+		self.elapsed = None
+
+	def run (self, ctx: GlobalContext):
+		t = time.monotonic()
+		try:
+			self.r.run(ctx)
+		finally:
+			self.elapsed = time.monotonic() - t
+
 class RoutineTask (Task):
 	def __init__ (self, ctx: GlobalContext, jobj: dict):
 		self.l = ctx.l.getChild("RoutineTask@" + jobj.get("id", hex(id(self))))
 		self.routines = [] # Should hold Runnables
+		self.steps = list[RoutineStep]()
+		self.parallel = jobj.get("parallel", False)
 
-		for i in jobj["routine"]:
+		for idx, i in enumerate(jobj["routine"]):
 			type_str = i["type"]
 
 			if type_str.startswith("exec"):
@@ -755,15 +2794,249 @@ class RoutineTask (Task):
 				raise RuntimeError("FIXME")
 
 			self.routines.append(r)
+			self.steps.append(RoutineStep(idx, i, r))
+
+		self._chk_steps()
+
+	def _chk_steps (self):
+		step_map = dict[str, RoutineStep]()
+		for s in self.steps:
+			if s.id in step_map:
+				raise InvalidConfigError("Duplicate routine id", s.id)
+			step_map[s.id] = s
+
+		for s in self.steps:
+			if s.depends and not self.parallel:
+				raise InvalidConfigError(
+					"'depends' used in non-parallel routine", s.id)
+			for d in s.depends:
+				if d not in step_map:
+					raise InvalidConfigError("Unknown routine id in 'depends'", d)
+
+		# The builtin functions are barriers. The steps can only depend on the
+		# steps that come before the next barrier
+		seg_map = dict[str, int]()
+		for i, seg in enumerate(self._segments()):
+			for s in seg:
+				seg_map[s.id] = i
+		for s in self.steps:
+			for d in s.depends:
+				if seg_map[d] > seg_map[s.id]:
+					raise InvalidConfigError(
+						"'depends' across a builtin function", s.id, d)
+
+		# Detect cycles by peeling off the steps with no pending dependency
+		pending = { s.id: set(s.depends) for s in self.steps }
+		while pending:
+			ready = [ k for k, v in pending.items() if not v ]
+			if not ready:
+				raise InvalidConfigError(
+					"Circular dependency in routine",
+					list(pending.keys()))
+			for k in ready:
+				del pending[k]
+			for v in pending.values():
+				v.difference_update(ready)
+
+	def _segments (self) -> list[list[RoutineStep]]:
+		'''
+		Split the steps at the builtin functions. Each builtin function forms
+		a segment of its own.
+		'''
+		ret = [ list[RoutineStep]() ]
+		for s in self.steps:
+			if isinstance(s.r, BuiltinRunnable):
+				ret.append([ s ])
+				ret.append(list[RoutineStep]())
+			else:
+				ret[-1].append(s)
+
+		return [ i for i in ret if i ]
+
+	def _run_seq (self, ctx: GlobalContext):
+		for s in self.steps:
+			self.l.info("run: " + str(s.r))
+			s.run(ctx)
+			self.l.debug("%s: %.3fs" % (s.id, s.elapsed))
+
+	def _run_parallel (self, ctx: GlobalContext):
+		'''
+		Run the steps whose dependencies are met concurrently. The builtin
+		functions are barriers: they are run in the calling thread after all
+		the steps before them complete and the steps after them are run on a
+		fresh thread pool so that the threads inherit the state set by the
+		builtin functions(e.g. sigmask).
+		'''
+		for seg in self._segments():
+			if len(seg) == 1 and isinstance(seg[0].r, BuiltinRunnable):
+				self.l.info("run: " + str(seg[0].r))
+				seg[0].run(ctx)
+			else:
+				self._run_segment(ctx, seg)
+
+	def _run_segment (self, ctx: GlobalContext, steps: list[RoutineStep]):
+		'''
+		No more steps are started once a step fails and the first exception is
+		raised after the running steps complete.
+		'''
+		nb_workers = ctx.nb_workers or len(steps)
+		pending = list(steps)
+		# The steps in the previous segments are done
+		done = set[str](i.id for i in self.steps if i not in steps)
+		running = dict[Future, RoutineStep]()
+		error = None
+
+		with ThreadPoolExecutor(max_workers = nb_workers) as th_pool:
+			while pending or running:
+				while error is None and len(running) < nb_workers:
+					s = next(
+						(i for i in pending if done.issuperset(i.depends)),
+						None)
+					if s is None:
+						break
+					pending.remove(s)
+
+					self.l.info("run: " + str(s.r))
+					running[th_pool.submit(s.run, ctx)] = s
+
+				if not running:
+					break
+
+				fs, _ = futures.wait(
+					running.keys(),
+					return_when = futures.FIRST_COMPLETED)
+				for f in fs:
+					s = running.pop(f)
+					e = f.exception()
+					if e is None:
+						self.l.debug("%s: %.3fs" % (s.id, s.elapsed))
+						done.add(s.id)
+					else:
+						self.l.error("%s failed: %s" % (s.id, repr(e)))
+						if error is None:
+							error = e
+
+		if error is not None:
+			raise error
+
+	def critical_path (self) -> tuple[list[RoutineStep], float]:
+		'''
+		Return the chain of the steps with the longest total run time and the
+		total run time of the chain. The chain goes through the builtin
+		functions as they are barriers.
+		'''
+		ret = ([], 0.0)
+
+		for seg in self._segments():
+			step_map = { s.id: s for s in seg }
+			memo = dict[str, tuple]()
+
+			def longest (s: RoutineStep) -> tuple:
+				if s.id not in memo:
+					path, t = max(
+						( longest(step_map[d]) for d in s.depends if d in step_map ),
+						key = lambda x: x[1],
+						default = ([], 0.0))
+					memo[s.id] = (path + [ s ], t + (s.elapsed or 0.0))
+				return memo[s.id]
+
+			path, t = max(
+				( longest(s) for s in seg ),
+				key = lambda x: x[1])
+			ret = (ret[0] + path, ret[1] + t)
+
+		return ret
 
 	def run (self, ctx: GlobalContext):
-		for r in self.routines:
-			self.l.info("run: " + str(r))
-			p = r.run(ctx)
+		t = time.monotonic()
+
+		if self.parallel:
+			self._run_parallel(ctx)
+		else:
+			self._run_seq(ctx)
+
+		if self.parallel and self.l.isEnabledFor(logging.DEBUG):
+			path, cp_t = self.critical_path()
+			self.l.debug("critical path: %s (%.3fs of %.3fs)" % (
+				" -> ".join([ i.id for i in path ]),
+				cp_t,
+				time.monotonic() - t))
+
 		return self
 
 	def __str__ (self) -> str:
-		return "\n".join([ str(i) for i in self.routines ])
+		if not self.parallel:
+			return "\n".join([ str(i) for i in self.routines ])
+		return "\n".join([
+			"%s%s: %s" % (
+				s.id,
+				" <- " + ", ".join(s.depends) if s.depends else "",
+				str(s.r))
+			for s in self.steps ])
+
+class Fingerprint:
+	'''
+	Identifies the input of a backup object without running the pipeline.
+	The digest covers the pipeline, the metadata of the input paths and the
+	output of the fingerprint Exec.
+	'''
+	def __init__ (self, ctx: GlobalContext, jobj: dict):
+		self.inputs = jobj.get("inputs", [])
+		if "exec" in jobj:
+			self.exec = Exec.from_conf(ctx, jobj["exec"])
+		else:
+			self.exec = None
+
+		if not self.inputs and self.exec is None:
+			raise InvalidConfigError("Empty fingerprint", jobj)
+
+	def _feed_stat (h, path: str):
+		try:
+			st = os.lstat(path)
+		except FileNotFoundError:
+			h.update(("%s\0-\0" % path).encode())
+			return
+		h.update(("%s\0%o\0%u\0%u\0%u\0" % (
+			path,
+			st.st_mode,
+			st.st_size,
+			st.st_mtime_ns,
+			st.st_ctime_ns)).encode())
+
+	def _feed_input (h, path: str):
+		Fingerprint._feed_stat(h, path)
+		if os.path.islink(path) or not os.path.isdir(path):
+			return
+
+		for root, dirs, files in os.walk(path):
+			dirs.sort()
+			for i in sorted(dirs + files):
+				Fingerprint._feed_stat(h, os.path.join(root, i))
+
+	def digest (self, ctx: GlobalContext, bo) -> str:
+		h = hashlib.sha256()
+
+		for eh in bo.pipeline:
+			h.update(str(eh).encode() + b"\0")
+		for i in self.inputs:
+			Fingerprint._feed_input(h, i)
+		if self.exec is not None:
+			stderr = ctx.capture(
+				bo.path + ":fingerprint",
+				"stderr",
+				self.exec.vl_stderr)
+			with popen_captured(
+				( stderr, ),
+				self.exec.argv,
+				env = self.exec.env,
+				stdout = subprocess.PIPE,
+				stderr = stderr.fd) as p:
+				for b in iter(lambda: p.stdout.read(ctx.child_io_size), b""):
+					h.update(b)
+				ec = p.wait()
+			self.exec.raise_oob_ec(ec, ( stderr, ))
+
+		return h.hexdigest()
 
 class BackupObject (Runnable):
 	def __init__ (
@@ -774,41 +3047,211 @@ class BackupObject (Runnable):
 		self.path = jobj["path"]
 		self.bbctx = None
 		self.alloc_size = jobj.get("alloc-size", None)
+		self.meter = False
+		self.meters = list[PipeMeter]()
+		self.t_start = None
+		self.t_end = None
+		self.nb_procs = 0
+		self.fp = None
+		self.reused = False
+		self.checksum = None
+		self.digest = None
+		self.buckets = list[TokenBucket]()
+		self.bb_bucket = None
+		self.throttle = TokenBucket.from_conf(jobj.get("throttle"))
+		self.throttled = None
+		if "fingerprint" in jobj:
+			self.fingerprint = Fingerprint(ctx, jobj["fingerprint"])
+		else:
+			self.fingerprint = None
 
 		for e in jobj["pipeline"]:
-			ny_exec = Exec.from_conf(ctx, e)
-			self.pipeline.append(ny_exec)
+			if e["type"] == "builtin":
+				self.pipeline.append(BuiltinFilterMap[e["builtin-id"]](e.get("param", {})))
+			else:
+				self.pipeline.append(Exec.from_conf(ctx, e))
 
-	def run (self, ctx: GlobalContext):
-		last_stdio = subprocess.DEVNULL # Just in case the pipeline is empty
-		pmap = {}
+		if "cost" in jobj:
+			self.cost = ResourceBudget.parse_cost(jobj["cost"])
+		else:
+			self.cost = ResourceBudget.sum_cost(i.cost for i in self.pipeline)
+		budget = ResourceBudget(ctx.budget)
+		for i in self.pipeline:
+			budget.chk_cost(i.cost, str(i))
+		budget.chk_cost(self.cost, self.path)
+
+	def test_digest (self, digest: str) -> bool:
+		'''
+		Test if the digest from the previous copy can be carried over.
+		'''
+		if self.checksum is None:
+			return True
+		return digest is not None and digest.startswith(self.checksum + ":")
+
+	def _stage_name (eh) -> str:
+		argv = eh.get_argv()
+		return os.path.basename(argv[0]) if argv else str(eh)
+
+	def _reuse (self, ctx: GlobalContext) -> bool:
+		self.meters = list[PipeMeter]()
+		self.throttled = None
+		self.t_start = time.monotonic()
+		if self.fingerprint is not None:
+			self.fp = self.fingerprint.digest(ctx, self)
+			self.reused = self.bbctx.reuse(ctx, self)
+			if self.reused:
+				self.t_end = time.monotonic()
+
+		return self.reused
+
+	def start (self, ctx: GlobalContext):
+		'''
+		Spawn the pipeline and the sink. The output of the pipeline is left in
+		self.stdio if the sink is a native sink.
+		'''
+		self.stdio = subprocess.DEVNULL # Just in case the pipeline is empty
+		self.pmap = {}
+		self.outputs = dict[Exec, tuple]()
+		self.relays = list[MeteredPipe]()
+		self.throttled = None
+		self.sink = None
 
-		for eh in self.pipeline:
-			p = subprocess.Popen(
-				args = eh.argv,
-				stdin = last_stdio,
-				stdout = subprocess.PIPE,
-				stderr = None if ctx.test_vl(eh.vl_stderr) else subprocess.DEVNULL,
-				env = eh.env)
-			pmap[eh] = p
-			last_stdio = p.stdout
-
-		sink_exec = self.bbctx.sink(ctx, self)
-		sink_p = subprocess.Popen(
-			args = sink_exec.argv,
-			stdin = last_stdio,
-			stdout = None if ctx.test_vl(sink_exec.vl_stdout) else subprocess.DEVNULL,
-			stderr = None if ctx.test_vl(sink_exec.vl_stderr) else subprocess.DEVNULL,
-			env = sink_exec.env)
-		pmap[sink_exec] = sink_p
-
-		for eh in pmap:
-			p = pmap[eh]
+		try:
+			i = 0
+			while i < len(self.pipeline):
+				eh = self.pipeline[i]
+				i += 1
+
+				if isinstance(eh, BuiltinFilter):
+					# Run the consecutive builtin stages on one thread
+					filters = [ eh ]
+					while (i < len(self.pipeline) and
+						isinstance(self.pipeline[i], BuiltinFilter)):
+						filters.append(self.pipeline[i])
+						i += 1
+					r = FilterPipe(
+						ctx,
+						None if self.stdio is subprocess.DEVNULL else self.stdio,
+						filters)
+					self.relays.append(r)
+					self.stdio = r.stdout
+					stage = "+".join(f.NAME for f in filters)
+				else:
+					stage = BackupObject._stage_name(eh)
+					stderr = ctx.capture(
+						self.path + ":" + stage,
+						"stderr",
+						eh.vl_stderr)
+					p = popen_captured(
+						( stderr, ),
+						args = eh.argv,
+						stdin = self.stdio,
+						stdout = subprocess.PIPE,
+						stderr = stderr.fd,
+						env = eh.env)
+					self.pmap[eh] = p
+					self.outputs[eh] = ( stderr, )
+					set_pipe_size(p.stdout.fileno(), ctx.pipe_size)
+					if self.stdio is not subprocess.DEVNULL:
+						# Only the child needs it from now on
+						self.stdio.close()
+					self.stdio = p.stdout
+
+				if self.meter:
+					r = MeteredPipe(ctx, self.stdio, stage)
+					self.relays.append(r)
+					self.meters.append(r.meter)
+					self.stdio = r.stdout
+
+			if self.buckets and self.stdio is not subprocess.DEVNULL:
+				r = ThrottledPipe(ctx, self.stdio, self.buckets)
+				self.relays.append(r)
+				self.throttled = r
+				self.stdio = r.stdout
+
+			self.sink = ThrottledSink.wrap(
+				ctx,
+				self.bbctx.sink(ctx, self),
+				self.bb_bucket,
+				self.path)
+			if self.checksum is not None:
+				if not isinstance(self.sink, NativeSink):
+					self.sink = ExecSink(ctx, self.sink, self.path)
+				self.sink = DigestSink(self.sink, self)
+			if not isinstance(self.sink, NativeSink):
+				outputs = self.sink.capture(ctx, self.path)
+				sink_p = popen_captured(
+					outputs,
+					args = self.sink.argv,
+					stdin = self.stdio,
+					stdout = outputs[0].fd,
+					stderr = outputs[1].fd,
+					env = self.sink.env)
+				self.pmap[self.sink] = sink_p
+				self.outputs[self.sink] = outputs
+		except:
+			self.abort(ctx)
+			raise
+
+	def abort (self, ctx: GlobalContext):
+		# Let the rest of the pipeline die of SIGPIPE
+		if self.stdio is not subprocess.DEVNULL:
+			self.stdio.close()
+		for r in self.relays:
+			r.th.join()
+		for p in self.pmap.values():
+			p.wait()
+
+	def finish (self, ctx: GlobalContext):
+		'''
+		Reap the pipeline and test the exit codes.
+		'''
+		if self.stdio is not subprocess.DEVNULL:
+			self.stdio.close()
+		for r in self.relays:
+			r.join()
+		for eh in self.pmap:
+			p = self.pmap[eh]
 			ec = p.wait()
-			eh.raise_oob_ec(ec)
+			eh.raise_oob_ec(ec, self.outputs.get(eh, ()))
+		for eh in self.pipeline:
+			r = eh.result() if isinstance(eh, BuiltinFilter) else None
+			if r is not None:
+				ctx.l.info("%s: %s: %s" % (self.path, eh.NAME, r))
+		self.t_end = time.monotonic()
+		self.nb_procs = len(self.pmap)
 
 		return self
 
+	def run (self, ctx: GlobalContext):
+		if self._reuse(ctx):
+			return self
+
+		self.start(ctx)
+		if isinstance(self.sink, NativeSink):
+			try:
+				self._run_native_sink(ctx, self.sink, self.stdio)
+			except:
+				self.abort(ctx)
+				raise
+
+		return self.finish(ctx)
+
+	def elapsed (self) -> float:
+		if self.t_start is None or self.t_end is None:
+			return None
+		return self.t_end - self.t_start
+
+	def _run_native_sink (self, ctx: GlobalContext, sink: NativeSink, stdio):
+		try:
+			if stdio is not subprocess.DEVNULL:
+				sink.drain(ctx, stdio.fileno())
+		except:
+			sink.abort(ctx)
+			raise
+		else:
+			sink.close(ctx)
+
 	def __str__ (self):
 		return " | ".join([ str(i) for i in self.pipeline ]) + " > " + self.path
 
@@ -887,6 +3330,408 @@ class DepResolv:
 
 		return "\n".join(sb)
 
+class RunHistory:
+	'''
+	The run time of the backup objects from the previous runs. Used to predict
+	how long each object will take.
+	'''
+	def __init__ (self, path: str = None):
+		self.path = path
+		self.elapsed = dict[str, float]()
+
+		if path is None:
+			return
+		try:
+			with open(path) as f:
+				jobj = json.load(f)
+			for k, v in jobj.get("objects", {}).items():
+				self.elapsed[k] = float(v["elapsed"])
+		except FileNotFoundError:
+			pass
+
+	def update (self, bo: BackupObject):
+		cur = bo.elapsed()
+		if cur is None or bo.reused:
+			# Keep the time it takes to make the object
+			return
+
+		prev = self.elapsed.get(bo.path)
+		if prev is None:
+			self.elapsed[bo.path] = cur
+		else:
+			a = DEFAULT.HIST_ALPHA.value
+			self.elapsed[bo.path] = a * cur + (1 - a) * prev
+
+	def save (self):
+		if self.path is None:
+			return
+
+		jobj = {
+			"objects": { k: { "elapsed": v } for k, v in self.elapsed.items() }
+		}
+		os.makedirs(os.path.dirname(self.path), exist_ok = True)
+		tmp = self.path + ".tmp"
+		with open(tmp, "w") as f:
+			json.dump(jobj, f)
+		os.replace(tmp, self.path)
+
+	def predict (self, objs: Iterable[BackupObject]) -> dict:
+		'''
+		Predict the run time of the objects. The objects without history are
+		estimated using alloc-size and the time per byte of the objects with
+		history. The median is used for the rest.
+		'''
+		ret = {}
+		known = sorted(self.elapsed[bo.path] for bo in objs if bo.path in self.elapsed)
+		median = known[len(known) // 2] if known else 0.0
+		t_sum = 0.0
+		b_sum = 0
+		for bo in objs:
+			if bo.path in self.elapsed and bo.alloc_size:
+				t_sum += self.elapsed[bo.path]
+				b_sum += bo.alloc_size
+		# Any positive value will do if none of them have history. Only the
+		# order matters
+		spb = t_sum / b_sum if b_sum else 1.0
+
+		for bo in objs:
+			if bo.path in self.elapsed:
+				ret[bo] = self.elapsed[bo.path]
+			elif bo.alloc_size is not None:
+				ret[bo] = bo.alloc_size * spb
+			else:
+				ret[bo] = median
+
+		return ret
+
+class BackupExecutor (ABC):
+	'''
+	Runs the backup objects despatched by the backup task.
+	'''
+	@abstractmethod
+	def submit (self, ctx: GlobalContext, bo: BackupObject):
+		...
+	@abstractmethod
+	def wait (self, ctx: GlobalContext) -> list[BackupObject]:
+		'''
+		Block until at least one of the objects is done. Return the objects
+		done.
+		'''
+		...
+	@abstractmethod
+	def __len__ (self) -> int:
+		# The number of the objects running
+		...
+
+	def __enter__ (self):
+		return self
+
+	def __exit__ (self, *args):
+		pass
+
+class ThreadExecutor (BackupExecutor):
+	'''
+	Runs each backup object on a thread from the pool.
+	'''
+	def __init__ (self, ctx: GlobalContext):
+		self.th_pool = ThreadPoolExecutor(max_workers = ctx.nb_workers)
+		self.fs = dict[Future, BackupObject]()
+
+	def submit (self, ctx: GlobalContext, bo: BackupObject):
+		self.fs[self.th_pool.submit(bo.run, ctx)] = bo
+
+	def wait (self, ctx: GlobalContext) -> list[BackupObject]:
+		ret = list[BackupObject]()
+		f_ret = futures.wait(
+			fs = self.fs.keys(),
+			return_when = futures.FIRST_COMPLETED)
+		for f in f_ret[0]:
+			del self.fs[f]
+			ret.append(f.result())
+
+		return ret
+
+	def __len__ (self) -> int:
+		return len(self.fs)
+
+	def __exit__ (self, *args):
+		self.th_pool.shutdown()
+
+class EventExecutor (BackupExecutor):
+	'''
+	Runs the backup objects from one thread. The child processes are reaped
+	as their pidfds become readable and the output of the pipelines is moved
+	to the native sinks as it becomes available. The data for the sinks that
+	write to a pipe is held back until the pipe becomes writable so that a
+	slow sink does not stall the other objects. The sinks that can't be
+	polled and the fingerprints are run on a small pool of threads instead.
+	The input of such a sink is parked until the pool is done with the data.
+	'''
+	def __init__ (self, ctx: GlobalContext):
+		if not hasattr(os, "pidfd_open"):
+			raise OSError(errno.ENOSYS, "pidfd_open() not available")
+
+		self.ctx = ctx
+		self.po = select.poll()
+		# fd: (bo, Popen or NativeSink)
+		self.fd_map = dict[int, tuple]()
+		# input fd: the data not yet taken by the sink
+		self.backlog = dict[int, memoryview]()
+		# poll_fd() of the sink: input fd
+		self.out_map = dict[int, int]()
+		# bo: number of fds pending
+		self.pending = dict[BackupObject, int]()
+		self.done = list[BackupObject]()
+		# The jobs on the pool. Future: (bo, "reuse" or "close") or
+		# (bo, "feed", input fd)
+		self.jobs = dict[Future, tuple]()
+		# The input fds parked while their sinks are on the pool
+		self.busy = set[int]()
+		# The jobs done, handed back through the wake pipe
+		self.results = deque()
+		self.wake_r, self.wake_w = os.pipe()
+		os.set_blocking(self.wake_r, False)
+		self.po.register(self.wake_r, select.POLLIN)
+		self.th_pool = ThreadPoolExecutor(
+			max_workers = DEFAULT.EVENT_WORKERS.value,
+			thread_name_prefix = "event")
+
+	def _add_fd (self, fd: int, bo: BackupObject, x):
+		self.po.register(fd, select.POLLIN)
+		self.fd_map[fd] = (bo, x)
+		self.pending[bo] = self.pending.get(bo, 0) + 1
+
+	def _del_fd (self, fd: int) -> BackupObject:
+		if fd in self.backlog:
+			# Parked. Waiting on the sink rather than the input
+			del self.backlog[fd]
+			for wfd in [ k for k, v in self.out_map.items() if v == fd ]:
+				self.po.unregister(wfd)
+				del self.out_map[wfd]
+		elif fd in self.busy:
+			# Parked. Waiting on the pool
+			self.busy.remove(fd)
+		else:
+			self.po.unregister(fd)
+		bo, x = self.fd_map.pop(fd)
+		if not isinstance(x, NativeSink):
+			os.close(fd)
+
+		self.pending[bo] -= 1
+		if self.pending[bo] <= 0:
+			del self.pending[bo]
+			return bo
+		return None
+
+	def _release (self, ctx: GlobalContext, bo: BackupObject):
+		self.pending[bo] -= 1
+		if self.pending[bo] <= 0:
+			del self.pending[bo]
+			self.done.append(bo.finish(ctx))
+
+	def _run_job (self, key: tuple, fn, *args):
+		f = self.th_pool.submit(fn, *args)
+		self.jobs[f] = key
+		f.add_done_callback(self._job_done)
+
+	def _job_done (self, f: Future):
+		# Called from the pool
+		self.results.append(f)
+		os.write(self.wake_w, b"\0")
+
+	def submit (self, ctx: GlobalContext, bo: BackupObject):
+		if bo.fingerprint is not None:
+			# Runs the commands of the fingerprint and asks the backend
+			self.pending[bo] = 1
+			self._run_job((bo, "reuse"), bo._reuse, ctx)
+			return
+
+		bo._reuse(ctx)
+		self._start(ctx, bo)
+
+	def _start (self, ctx: GlobalContext, bo: BackupObject):
+		bo.start(ctx)
+		self.pending[bo] = 1
+		try:
+			for p in bo.pmap.values():
+				self._add_fd(os.pidfd_open(p.pid), bo, p)
+
+			if isinstance(bo.sink, NativeSink):
+				if bo.stdio is subprocess.DEVNULL:
+					self.pending[bo] += 1
+					self._run_job((bo, "close"), bo.sink.close, ctx)
+				else:
+					self._add_fd(bo.stdio.fileno(), bo, bo.sink)
+		except:
+			self._abort(ctx, bo)
+			raise
+
+		self._release(ctx, bo)
+
+	def _feed (self, ctx: GlobalContext, fd: int, sink: NativeSink) -> int:
+		'''
+		Move the data available from the input fd to the sink. Run on the pool.
+		'''
+		po = select.poll()
+		po.register(fd, select.POLLIN)
+		for i in range(DEFAULT.EVENT_FEEDS.value):
+			n = sink.feed(ctx, fd)
+			if not n:
+				sink.close(ctx)
+				break
+			if not po.poll(0):
+				break
+		return n
+
+	def _flush (self, ctx: GlobalContext, fd: int, sink: NativeSink):
+		'''
+		Write the backlog of the input fd to the sink. The input is parked
+		while the sink can't take more data.
+		'''
+		mv = self.backlog[fd]
+		while mv:
+			n = sink.write_some(ctx, mv)
+			if not n:
+				break
+			mv = mv[n:]
+
+		wfd = sink.poll_fd()
+		parked = wfd in self.out_map
+		if mv:
+			self.backlog[fd] = mv
+			if not parked:
+				self.po.unregister(fd)
+				self.po.register(wfd, select.POLLOUT)
+				self.out_map[wfd] = fd
+		else:
+			del self.backlog[fd]
+			if parked:
+				self.po.unregister(wfd)
+				del self.out_map[wfd]
+				self.po.register(fd, select.POLLIN)
+
+	def _on_event (self, ctx: GlobalContext, fd: int):
+		if fd in self.out_map:
+			fd = self.out_map[fd]
+			self._flush(ctx, fd, self.fd_map[fd][1])
+			return
+
+		bo, x = self.fd_map[fd]
+
+		if isinstance(x, NativeSink):
+			if x.poll_fd() is None:
+				self.po.unregister(fd)
+				self.busy.add(fd)
+				self._run_job((bo, "feed", fd), self._feed, ctx, fd, x)
+				return
+			b = os.read(fd, ctx.child_io_size)
+			if b:
+				self.backlog[fd] = memoryview(b)
+				self._flush(ctx, fd, x)
+				return
+			x.close(ctx)
+		else:
+			x.wait()
+
+		if self._del_fd(fd) is bo:
+			self.done.append(bo.finish(ctx))
+
+	def _on_result (self, ctx: GlobalContext, f: Future, key: tuple):
+		bo, kind = key[0], key[1]
+
+		if kind == "reuse":
+			del self.pending[bo]
+			if f.result():
+				self.done.append(bo)
+			else:
+				self._start(ctx, bo)
+		elif kind == "close":
+			f.result()
+			self._release(ctx, bo)
+		elif f.result():
+			self.busy.remove(key[2])
+			self.po.register(key[2], select.POLLIN)
+		elif self._del_fd(key[2]) is bo:
+			self.done.append(bo.finish(ctx))
+
+	def _on_wake (self, ctx: GlobalContext):
+		try:
+			os.read(self.wake_r, 4096)
+		except BlockingIOError:
+			pass
+
+		while self.results:
+			f = self.results.popleft()
+			key = self.jobs.pop(f, None)
+			if key is None:
+				# Aborted
+				continue
+			try:
+				self._on_result(ctx, f, key)
+			except:
+				# Aborted by _start() if it got that far
+				if key[1] != "reuse":
+					self._abort(ctx, key[0])
+				raise
+
+	def wait (self, ctx: GlobalContext) -> list[BackupObject]:
+		while not self.done:
+			for fd, ev in self.po.poll():
+				if fd == self.wake_r:
+					self._on_wake(ctx)
+					continue
+				try:
+					self._on_event(ctx, fd)
+				except:
+					fd = self.out_map.get(fd, fd)
+					self._abort(ctx, self.fd_map[fd][0] if fd in self.fd_map else None)
+					raise
+
+		ret = self.done
+		self.done = list[BackupObject]()
+		return ret
+
+	def _abort (self, ctx: GlobalContext, bo: BackupObject):
+		started = True
+		# The sinks are not thread safe. Let the jobs of the object finish
+		for f, key in list(self.jobs.items()):
+			if key[0] is not bo:
+				continue
+			del self.jobs[f]
+			futures.wait([ f ])
+			if key[1] == "reuse":
+				started = False
+
+		for fd, (i, x) in list(self.fd_map.items()):
+			if i is not bo:
+				continue
+			if isinstance(x, NativeSink):
+				x.abort(ctx)
+			self._del_fd(fd)
+		self.pending.pop(bo, None)
+		if bo is not None and started:
+			bo.abort(ctx)
+
+	def __len__ (self) -> int:
+		return len(self.pending) + len(self.done)
+
+	def __exit__ (self, *args):
+		try:
+			# Only on error. Let the other pipelines die of SIGPIPE
+			while self.fd_map:
+				self._abort(self.ctx, next(iter(self.fd_map.values()))[0])
+			while self.jobs:
+				self._abort(self.ctx, next(iter(self.jobs.values()))[0])
+		finally:
+			self.th_pool.shutdown()
+			os.close(self.wake_r)
+			os.close(self.wake_w)
+
+BackupExecutorMap = {
+	"thread": ThreadExecutor,
+	"event": EventExecutor
+}
+
 class BackupTask (Task):
 	def __init__ (self, ctx: GlobalContext, jobj: dict):
 		og_map = {}
@@ -894,8 +3739,54 @@ class BackupTask (Task):
 		jobj_list = jobj.get("objects", [])
 		obj_path_set = set()
 
-		self.l = ctx.l.getChild("BackupTask@" + jobj.get("id", hex(id(self))))
-		self.bb = ctx.backup_backends[jobj["backend"]](jobj.get("backend-param"))
+		self.id = jobj.get("id", hex(id(self)))
+		# The id of the task changes every run if not specified
+		self.persistent = "id" in jobj
+		self.l = ctx.l.getChild("BackupTask@" + self.id)
+		if "backends" in jobj:
+			if "backend" in jobj:
+				raise InvalidConfigError(
+					"'backend' and 'backends' are mutually exclusive",
+					self.id)
+			if "backend-throttle" in jobj:
+				raise InvalidConfigError(
+					"'backend-throttle' cannot be used with 'backends'",
+					self.id)
+			self.bb = MultiBackupBackend(
+				[ ctx.backup_backends[i["backend"]](i.get("backend-param"))
+					for i in jobj["backends"] ],
+				[ TokenBucket.from_conf(i.get("throttle"))
+					for i in jobj["backends"] ])
+			self.bb_bucket = None
+		else:
+			self.bb = ctx.backup_backends[jobj["backend"]](jobj.get("backend-param"))
+			self.bb_bucket = TokenBucket.from_conf(jobj.get("backend-throttle"))
+		# Shared by all the objects of the task. The limits of the backends are
+		# applied to their sinks
+		self.throttle = TokenBucket.from_conf(jobj.get("throttle"))
+		self.buckets = [ i for i in
+			[ ctx.throttle, self.throttle ]
+			if i is not None ]
+		self.objects = list[BackupObject]()
+		self.executor = jobj.get("executor", "thread")
+		if not self.executor in BackupExecutorMap:
+			raise InvalidConfigError("Invalid 'executor'", self.executor)
+		self.checksum = jobj.get("checksum")
+		if (self.checksum is not None and
+			not self.checksum in hashlib.algorithms_available):
+			raise InvalidConfigError("Unsupported checksum algorithm", self.checksum)
+
+		meter = jobj.get("meter", False)
+		if isinstance(meter, dict):
+			self.meter = True
+			self.meter_report = meter.get("report")
+			self.meter_fmt = meter.get("format", "json")
+		else:
+			self.meter = bool(meter)
+			self.meter_report = None
+			self.meter_fmt = None
+		if self.meter_fmt is not None and not self.meter_fmt in MeterReportMap:
+			raise InvalidConfigError("Invalid meter report format", self.meter_fmt)
 
 		# check for dup ids
 		for og in jobj_ogrps:
@@ -926,44 +3817,190 @@ class BackupTask (Task):
 			if path in obj_path_set:
 				raise KeyError("Duplicate path", path)
 			obj_path_set.add(path)
-			og_map[gid].objects.append(BackupObject(jo, ctx))
+			bo = BackupObject(jo, ctx)
+			bo.meter = self.meter
+			bo.checksum = self.checksum
+			bo.buckets = self.buckets + (
+				[ bo.throttle ] if bo.throttle is not None else [])
+			bo.bb_bucket = self.bb_bucket
+			og_map[gid].objects.append(bo)
+			self.objects.append(bo)
 
 		self.dep_tree = DepResolv.build(og_map)
 
 	def run (self, ctx: GlobalContext):
-		fs = set()
-
-		with (self.bb.open(ctx) as bbctx,
-			ThreadPoolExecutor(max_workers = ctx.nb_workers) as th_pool):
-			while self.dep_tree.avail_q or self.dep_tree.obj_dep_map:
-				if not fs and not self.dep_tree.avail_q:
-					# No despatched task units, but DepResolv won't return more work
-					raise RuntimeError("Invalid dependancy tree!")
-
-				for bo in self.dep_tree.avail_q:
-					bo.bbctx = bbctx
-					self.l.info("make: " + bo.path)
-					self.l.debug("despatch: " + str(bo))
-					fs.add(th_pool.submit(bo.run, ctx))
-				self.dep_tree.avail_q.clear()
-
-				f_ret = futures.wait(
-					fs = fs,
-					return_when = futures.FIRST_COMPLETED)
-				for f in f_ret[0]:
-					r = f.result()
-					self.l.debug("reap: " + str(bo))
-					self.dep_tree.mark_fulfilled(r)
-				fs.difference_update(f_ret[0])
+		try:
+			return self._do_run(ctx)
+		finally:
+			if self.meter:
+				self._report_meters(ctx)
+			if self.buckets:
+				self._report_throttle(ctx)
+
+	def _report_throttle (self, ctx: GlobalContext):
+		relays = [ bo.throttled for bo in self.objects if bo.throttled is not None ]
+		for bo in self.objects:
+			if bo.throttled is not None:
+				self.l.info("throttle: %s: %s" % (bo.path, str(bo.throttled)))
+		if not relays:
+			return
 
-			for f in fs:
-				self.dep_tree.mark_fulfilled(f.result())
+		nb_bytes = sum(i.nb_bytes for i in relays)
+		wall = (
+			max(i.t_end or i.t_start for i in relays) -
+			min(i.t_start for i in relays))
+		self.l.info("throttle: total %u bytes, %.2f MB/s" % (
+			nb_bytes,
+			nb_bytes / wall / 1000000 if wall > 0 else 0.0))
+
+	def _report_meters (self, ctx: GlobalContext):
+		for bo in self.objects:
+			for m in bo.meters:
+				self.l.info("meter: %s: %s" % (bo.path, str(m)))
+
+		if self.meter_report is None:
+			return
+		try:
+			doc = MeterReportMap[self.meter_fmt](self)
+			tmp = self.meter_report + ".tmp"
+			# The report may be read by others(node_exporter) at any time
+			with open(tmp, "w") as f:
+				f.write(doc)
+			os.replace(tmp, self.meter_report)
+		except OSError as e:
+			self.l.error("failed to write meter report: " + str(e))
+
+	def _history_path (self, ctx: GlobalContext) -> str:
+		if ctx.state_dir is None or not self.persistent:
+			return None
+		return os.sep.join([ ctx.state_dir, "history", self.id + ".json" ])
+
+	def _calc_rank (self, hist: RunHistory) -> dict:
+		'''
+		Rank the objects by the predicted run time of the longest chain of
+		objects that can only start after the object.
+		'''
+		pred = hist.predict(self.objects)
+		ret = {}
+
+		def dependants (bo: BackupObject) -> set:
+			return self.dep_tree.dep_obj_map.get(bo, set())
+
+		# The sets are transitive. The dependants of an object always have
+		# fewer dependants than the object itself
+		for bo in sorted(self.objects, key = lambda x: len(dependants(x))):
+			ret[bo] = pred[bo] + max(
+				( ret[i] for i in dependants(bo) ),
+				default = 0.0)
+
+		return ret
+
+	def _do_run (self, ctx: GlobalContext):
+		ready = list[BackupObject]()
+		hist = RunHistory(self._history_path(ctx))
+		rank = self._calc_rank(hist)
+		budget = ResourceBudget(ctx.budget)
+
+		try:
+			with (self.bb.open(ctx) as bbctx,
+				BackupExecutorMap[self.executor](ctx) as ex):
+				while (ready or
+					self.dep_tree.avail_q or
+					self.dep_tree.obj_dep_map):
+					# Longest processing time first
+					ready.extend(self.dep_tree.avail_q)
+					self.dep_tree.avail_q.clear()
+					ready.sort(key = rank.get, reverse = True)
+
+					if not len(ex) and not ready:
+						# No despatched task units, but DepResolv won't return more work
+						raise RuntimeError("Invalid dependancy tree!")
+
+					# Hold back the rest so that the objects that become
+					# available later can jump the queue. The objects that do
+					# not fit in the budget are skipped for the smaller ones
+					i = 0
+					while i < len(ready) and ctx.test_workers(len(ex) + 1):
+						bo = ready[i]
+						if not budget.test(bo.cost):
+							i += 1
+							continue
+						del ready[i]
+						budget.acquire(bo.cost)
+						bo.bbctx = bbctx
+						self.l.info("make: " + bo.path)
+						self.l.debug("despatch: %s (rank %.3f)" % (str(bo), rank[bo]))
+						ex.submit(ctx, bo)
+
+					for r in ex.wait(ctx):
+						budget.release(r.cost)
+						self.l.debug("reap: " + str(r))
+						self.dep_tree.mark_fulfilled(r)
+
+				while len(ex):
+					for r in ex.wait(ctx):
+						self.dep_tree.mark_fulfilled(r)
+		finally:
+			for bo in self.objects:
+				hist.update(bo)
+			try:
+				hist.save()
+			except OSError as e:
+				self.l.error("failed to save history: " + str(e))
 
 		return self
 
 	def __str__ (self):
 		return "bb: " + str(self.bb) + "\n" + ("obj_dep_tree:\n" + str(self.dep_tree).strip()).replace("\n", "\n\t")
 
+def fmt_meter_json (task: BackupTask) -> str:
+	doc = {
+		"task": task.id,
+		"time": datetime.now(timezone.utc).isoformat(timespec = "seconds"),
+		"objects": [
+			{
+				"path": bo.path,
+				"stages": [ m.to_jobj() for m in bo.meters ]
+			}
+			for bo in task.objects if bo.meters
+		]
+	}
+	return json.dumps(doc, indent = "\t") + "\n"
+
+def fmt_meter_prom (task: BackupTask) -> str:
+	def esc (x: str) -> str:
+		return x.replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+	METRICS = [
+		("bytes", "Bytes produced by the stage", "counter"),
+		("wall", "Wall time of the stage in seconds", "gauge"),
+		("idle", "Seconds spent waiting for the stage to produce output", "gauge"),
+		("stall", "Seconds spent waiting for the next stage to consume output", "gauge"),
+		("throughput", "Output of the stage in bytes per second", "gauge")
+	]
+	sb = []
+
+	for name, desc, t in METRICS:
+		metric = "palhm_backup_stage_" + name
+		sb.append("# HELP %s %s" % (metric, desc))
+		sb.append("# TYPE %s %s" % (metric, t))
+		for bo in task.objects:
+			for i, m in enumerate(bo.meters):
+				sb.append('%s{task="%s",object="%s",nb="%u",stage="%s"} %s' % (
+					metric,
+					esc(task.id),
+					esc(bo.path),
+					i,
+					esc(m.stage),
+					repr(m.to_jobj()[name])))
+
+	return "\n".join(sb) + "\n"
+
+MeterReportMap = {
+	"json": fmt_meter_json,
+	"prom": fmt_meter_prom
+}
+
 TaskClassMap = {
 	"backup": BackupTask,
 	"routine": RoutineTask
@@ -998,26 +4035,58 @@ def merge_conf (a: dict, b: dict) -> dict:
 
 	return ret
 
-def load_jsonc (path: str) -> dict:
-	with (open(path) as in_file,
-		subprocess.Popen(
-			[ "/bin/json_reformat" ],
-			stdin = in_file,
-			stdout = subprocess.PIPE) as p):
-		ret = json.load(p.stdout)
-
-		if p.wait() != 0:
-			raise ChildProcessError(p, path)
+class JSONC (Enum):
+	# The strings are matched first so that the comment tokens in them are
+	# left alone
+	RE_COMMENT = re.compile(r'''"(?:[^"\\]|\\.)*"?|//[^\n]*|/\*(?:.*?\*/)?''', re.S)
+	RE_TRAILING_COMMA = re.compile(r'''"(?:[^"\\]|\\.)*"?|,(?=\s*[\]}])''')
+	RE_NOT_NL = re.compile(r"[^\n]")
+
+def strip_jsonc (doc: str) -> str:
+	'''
+	Turn the JSONC document into JSON by blanking out the comments and the
+	trailing commas. The length of the document and the line breaks are kept
+	so that the errors from the JSON parser point to the original location.
+	'''
+	def blank_comment (m: re.Match) -> str:
+		x = m[0]
+		if x[0] == '"':
+			return x
+		# An unterminated comment only matches "/*"
+		if x.startswith("/*") and not x.endswith("*/"):
+			raise json.JSONDecodeError("Unterminated comment", doc, m.start())
+		return JSONC.RE_NOT_NL.value.sub(" ", x)
+
+	def blank_comma (m: re.Match) -> str:
+		return m[0] if m[0][0] == '"' else " "
+
+	ret = JSONC.RE_COMMENT.value.sub(blank_comment, doc)
+	return JSONC.RE_TRAILING_COMMA.value.sub(blank_comma, ret)
 
-	return ret
+def load_jsonc (path: str) -> dict:
+	with open(path) as f:
+		doc = f.read()
 
-def load_conf (path: str, inc_set: set = set()) -> dict:
+	try:
+		return json.loads(strip_jsonc(doc))
+	except json.JSONDecodeError as e:
+		raise json.JSONDecodeError(path + ": " + e.msg, doc, e.pos) from None
+
+def load_conf (path: str, inc_set: set = None, deps: list = None) -> dict:
+	'''
+	Load the config and the configs included in it. The realpath and the
+	stat fingerprint of every file read are appended to `deps` if specified.
+	'''
 	JSONC_EXT = ".jsonc"
 
+	if inc_set is None:
+		inc_set = set[str]()
 	rpath = os.path.realpath(path)
 	if rpath in inc_set:
 		raise RecursionError("Config already included", rpath)
 	inc_set.add(rpath)
+	if deps is not None:
+		deps.append(ConfCache.stat_dep(rpath))
 
 	if rpath[-len(JSONC_EXT):].lower() == JSONC_EXT:
 		jobj = load_jsonc(rpath)
@@ -1033,7 +4102,7 @@ def load_conf (path: str, inc_set: set = set()) -> dict:
 	os.chdir(dn)
 
 	for i in jobj.get("include", iter(())):
-		inc_conf = load_conf(i, inc_set)
+		inc_conf = load_conf(i, inc_set, deps)
 		jobj = merge_conf(jobj, inc_conf)
 
 	# popd
@@ -1041,5 +4110,96 @@ def load_conf (path: str, inc_set: set = set()) -> dict:
 
 	return jobj
 
+class ConfCache:
+	'''
+	On-disk cache of the merged config documents. The cached document is
+	keyed on the realpath of the root config and is valid as long as none of
+	the files in the include graph is replaced or modified. The documents
+	are stored in marshal format which is much quicker to load than parsing
+	and merging the JSON(C) files.
+	'''
+	VERSION = 1
+
+	def default_dir () -> str:
+		ret = os.getenv("PALHM_CACHE_DIR")
+		if ret:
+			return ret
+		if os.geteuid() == 0:
+			return "/var/cache/palhm"
+		return os.path.join(
+			os.getenv("XDG_CACHE_HOME") or
+				os.path.join(os.path.expanduser("~"), ".cache"),
+			"palhm")
+
+	def stat_dep (rpath: str) -> tuple:
+		st = os.stat(rpath)
+		return (rpath, st.st_dev, st.st_ino, st.st_size, st.st_mtime_ns)
+
+	def __init__ (self, path: str, cache_dir: str = None):
+		self.rpath = os.path.realpath(path)
+		self.cache_dir = cache_dir or ConfCache.default_dir()
+		self.cache_path = os.path.join(
+			self.cache_dir,
+			hashlib.sha1(self.rpath.encode()).hexdigest() + ".conf")
+		self.hit = None
+		self.deps = list[tuple]()
+
+	def _read (self) -> dict:
+		try:
+			with open(self.cache_path, "rb") as f:
+				ver, deps, jobj = marshal.load(f)
+		except (OSError, EOFError, ValueError, TypeError):
+			return None
+
+		if ver != (ConfCache.VERSION, sys.hexversion) or not deps:
+			return None
+		try:
+			for i in deps:
+				if ConfCache.stat_dep(i[0]) != tuple(i):
+					return None
+		except OSError:
+			return None
+
+		self.deps = [ tuple(i) for i in deps ]
+		return jobj
+
+	def _write (self, jobj: dict):
+		tmp = "%s.%d.tmp" % (self.cache_path, os.getpid())
+		try:
+			os.makedirs(self.cache_dir, 0o700, True)
+			with open(tmp, "wb") as f:
+				marshal.dump(
+					((ConfCache.VERSION, sys.hexversion), self.deps, jobj),
+					f)
+			os.replace(tmp, self.cache_path)
+		except (OSError, ValueError):
+			# The cache is only an optimisation. Read-only file systems or
+			# unmarshallable documents just disable it.
+			try:
+				os.unlink(tmp)
+			except OSError:
+				pass
+
+	def load (self) -> dict:
+		ret = self._read()
+		self.hit = ret is not None
+		if self.hit:
+			return ret
+
+		self.deps = list[tuple]()
+		ret = load_conf(self.rpath, deps = self.deps)
+		self._write(ret)
+
+		return ret
+
+	def invalidate (self):
+		try:
+			os.unlink(self.cache_path)
+		except FileNotFoundError:
+			pass
+
+def load_conf_cached (path: str, cache_dir: str = None) -> dict:
+	return ConfCache(path, cache_dir).load()
+
 def setup_conf (jobj: dict) -> GlobalContext:
 	return GlobalContext(jobj)
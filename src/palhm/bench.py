@@ -0,0 +1,261 @@
+# Copyright (c) 2022 David Timber <dxdt@dev.snart.me>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+import resource
+import shutil
+import subprocess
+import tempfile
+import time
+from enum import Enum
+from typing import Iterable
+
+from . import BackupTask, GlobalContext
+from .exceptions import InvalidConfigError
+
+
+class CONST (Enum):
+	SHAPES = ( "flat", "chain", "fan-in" )
+	BACKENDS = ( "null", "localfs", "aws-s3" )
+	SIZE_SUFFIX = { "K": 1 << 10, "M": 1 << 20, "G": 1 << 30 }
+
+def parse_size (x: str) -> int:
+	x = x.strip().upper()
+	if x and x[-1] in CONST.SIZE_SUFFIX.value:
+		return int(x[:-1]) * CONST.SIZE_SUFFIX.value[x[-1]]
+	return int(x)
+
+class BenchParam:
+	def __init__ (self):
+		self.nb_objects = 16
+		self.size = 1 << 20
+		self.depth = 1
+		self.shapes = list(CONST.SHAPES.value)
+		self.backends = [ "null", "localfs" ]
+		self.nb_workers = 0
+		self.rounds = 1
+		self.root = None
+		self.s3_bucket = None
+		self.s3_endpoint = None
+		self.s3_profile = "default"
+
+	def validate (self):
+		for i in self.shapes:
+			if not i in CONST.SHAPES.value:
+				raise InvalidConfigError("Unknown shape", i)
+		for i in self.backends:
+			if not i in CONST.BACKENDS.value:
+				raise InvalidConfigError("Unknown backend", i)
+		if "aws-s3" in self.backends and not self.s3_bucket:
+			raise InvalidConfigError("S3 bucket required for aws-s3")
+		if self.nb_objects <= 0 or self.depth <= 0 or self.rounds <= 0:
+			raise InvalidConfigError("Invalid parametres")
+
+		return self
+
+	def mk_objects (self, shape: str) -> tuple[list, list]:
+		'''
+		Generate object groups and objects for the dependency shape.
+
+		flat: no dependency
+		chain: each object depends on the previous one
+		fan-in: the last object depends on all the others
+		'''
+		ogrps = []
+		objs = []
+
+		for i in range(self.nb_objects):
+			pipeline = [ {
+				"type": "exec-inline",
+				"argv": [ "/bin/head", "-c", str(self.size), "/dev/zero" ]
+			} ]
+			for _ in range(1, self.depth):
+				pipeline.append({
+					"type": "exec-inline",
+					"argv": [ "/bin/cat" ]
+				})
+			o = { "path": "obj-%u" % i, "pipeline": pipeline }
+
+			if shape == "chain":
+				g = { "id": "g%u" % i }
+				if i > 0:
+					g["depends"] = [ "g%u" % (i - 1) ]
+				ogrps.append(g)
+				o["group"] = g["id"]
+			elif shape == "fan-in":
+				if i + 1 < self.nb_objects:
+					o["group"] = "leaves"
+				else:
+					o["group"] = "sink"
+			objs.append(o)
+
+		if shape == "fan-in":
+			ogrps = [
+				{ "id": "leaves" },
+				{ "id": "sink", "depends": [ "leaves" ] }
+			]
+
+		return (ogrps, objs)
+
+	def mk_backend_param (self, backend: str, root: str) -> dict:
+		if backend == "localfs":
+			return { "root": root, "nb-copy-limit": 1 }
+		if backend == "aws-s3":
+			return {
+				"profile": self.s3_profile,
+				"endpoint-url": self.s3_endpoint,
+				"bucket": self.s3_bucket,
+				"root": "palhm-bench",
+				"nb-copy-limit": 1
+			}
+		return {}
+
+	def mk_conf (self, backend: str, shape: str, root: str) -> dict:
+		ogrps, objs = self.mk_objects(shape)
+
+		return {
+			"modules": [ "aws" ] if backend == "aws-s3" else [],
+			"nb-workers": self.nb_workers,
+			"vl": 1,
+			"tasks": [
+				{
+					"id": "bench",
+					"type": "backup",
+					"backend": backend,
+					"backend-param": self.mk_backend_param(backend, root),
+					"object-groups": ogrps,
+					"objects": objs
+				}
+			]
+		}
+
+class BenchResult:
+	def __init__ (self, backend: str, shape: str):
+		self.backend = backend
+		self.shape = shape
+		self.nb_objects = 0
+		self.nb_bytes = 0
+		self.nb_procs = 0
+		self.wall = 0.0
+		self.busy = 0.0
+		self.nb_workers = 0
+		self.fork_cost = 0.0
+		self.maxrss = 0
+		self.maxrss_children = 0
+
+	def objs_per_sec (self) -> float:
+		return self.nb_objects / self.wall if self.wall > 0 else 0.0
+
+	def mbps (self) -> float:
+		return self.nb_bytes / self.wall / 1000000 if self.wall > 0 else 0.0
+
+	def fork_overhead (self) -> float:
+		# Estimated time spent on spawning the child processes
+		return self.nb_procs * self.fork_cost
+
+	def sched_idle (self) -> float:
+		# Worker time not spent on running objects
+		return max(0.0, self.wall * self.nb_workers - self.busy)
+
+	def to_jobj (self) -> dict:
+		return {
+			"backend": self.backend,
+			"shape": self.shape,
+			"objects": self.nb_objects,
+			"bytes": self.nb_bytes,
+			"wall": self.wall,
+			"objects-per-sec": self.objs_per_sec(),
+			"mbps": self.mbps(),
+			"procs": self.nb_procs,
+			"fork-overhead": self.fork_overhead(),
+			"maxrss": self.maxrss,
+			"maxrss-children": self.maxrss_children,
+			"sched-idle": self.sched_idle()
+		}
+
+	def header () -> str:
+		return "%-8s %-7s %6s %9s %9s %6s %9s %10s %10s %9s" % (
+			"BACKEND",
+			"SHAPE",
+			"OBJS",
+			"WALL(s)",
+			"OBJS/s",
+			"MB/s",
+			"FORK(s)",
+			"RSS(KiB)",
+			"CRSS(KiB)",
+			"IDLE(s)")
+
+	def __str__ (self) -> str:
+		return "%-8s %-7s %6u %9.3f %9.2f %6.1f %9.3f %10u %10u %9.3f" % (
+			self.backend,
+			self.shape,
+			self.nb_objects,
+			self.wall,
+			self.objs_per_sec(),
+			self.mbps(),
+			self.fork_overhead(),
+			self.maxrss,
+			self.maxrss_children,
+			self.sched_idle())
+
+def measure_fork_cost (n: int = 32) -> float:
+	'''
+	Mean time it takes to spawn and reap a trivial child process.
+	'''
+	t = time.monotonic()
+	for _ in range(n):
+		subprocess.run([ "/bin/true" ])
+	return (time.monotonic() - t) / n
+
+def run_once (param: BenchParam, backend: str, shape: str) -> BenchResult:
+	ret = BenchResult(backend, shape)
+	root = tempfile.mkdtemp(prefix = "palhm-bench.", dir = param.root)
+
+	try:
+		ctx = GlobalContext(param.mk_conf(backend, shape, root))
+		task: BackupTask = ctx.task_map["bench"]
+
+		t = time.monotonic()
+		task.run(ctx)
+		ret.wall = time.monotonic() - t
+	finally:
+		shutil.rmtree(root, ignore_errors = True)
+
+	ret.nb_workers = ctx.nb_workers or len(task.objects)
+	ret.nb_objects = len(task.objects)
+	ret.nb_bytes = param.size * len(task.objects)
+	for bo in task.objects:
+		ret.busy += bo.elapsed()
+		ret.nb_procs += bo.nb_procs
+	ret.maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+	ret.maxrss_children = resource.getrusage(
+		resource.RUSAGE_CHILDREN).ru_maxrss
+
+	return ret
+
+def run_bench (param: BenchParam) -> Iterable[BenchResult]:
+	param.validate()
+	fork_cost = measure_fork_cost()
+
+	for backend in param.backends:
+		for shape in param.shapes:
+			for _ in range(param.rounds):
+				r = run_once(param, backend, shape)
+				r.fork_cost = fork_cost
+				yield r
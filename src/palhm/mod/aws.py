@@ -17,20 +17,56 @@
 # LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 # SOFTWARE.
+import json
+import os
+import threading
+from concurrent import futures
 from concurrent.futures import ThreadPoolExecutor, Future
 from decimal import Decimal
 from enum import Enum
+from queue import Queue
 from time import sleep
-from typing import Callable, Iterable
+from typing import Callable, Iterable, Union
 
 import boto3
 import botocore
-from palhm import MUA, BackupBackend, BackupObject, Exec, GlobalContext
-from palhm.exceptions import APIFailError
+from botocore.config import Config
+from palhm import (MUA, BackupBackend, BackupManifest, BackupObject, Exec,
+				   GlobalContext, NativeSink, VerifyResult)
+from palhm.exceptions import APIFailError, InvalidConfigError
 
 
 class CONST (Enum):
 	AWSCLI = "/bin/aws"
+	MIN_PART_SIZE = 5242880 # 5MiB
+	DEFAULT_PART_SIZE = 8388608 # 8MiB
+	MAX_PARTS = 10000
+	# The part size is doubled every this number of parts so that the size of
+	# the object is not limited by the initial part size
+	PART_SIZE_STEP = 1000
+	DEFAULT_PARTS_INFLIGHT = 2
+	INDEX_NAME = ".palhm-index.json"
+	MAX_DELETE_KEYS = 1000
+	DELETE_RETRIES = 3
+	DELETE_BACKOFF = 0.5
+	MAX_ERRORS_SHOWN = 10
+	DEFAULT_ROT_PART_SIZE = 67108864 # 64MiB
+	MAX_COPY_SIZE = 5368709120 # 5GiB
+	FP_META = "palhm-fingerprint"
+	CHECKSUM_MAP = {
+		"sha256": "SHA256",
+		"sha1": "SHA1"
+	}
+	DEFAULT_CHECKSUM = "CRC32"
+	VERIFY_RANGE_SIZE = 8388608 # 8MiB
+	VERIFY_RANGES_INFLIGHT = 4
+	INDEX_VERSION = 2
+	# The storage classes of the objects that have to be restored to be read
+	ARCHIVE_SC = frozenset([ "GLACIER", "DEEP_ARCHIVE" ])
+
+def nb_pool_workers (ctx: GlobalContext) -> int:
+	# Mimic ThreadPoolExecutor
+	return ctx.nb_workers or min(32, (os.cpu_count() or 1) + 4)
 
 def mks3objkey (keys: Iterable[str]) -> str:
 	ret = "/".join(keys)
@@ -39,9 +75,192 @@ def mks3objkey (keys: Iterable[str]) -> str:
 def mks3uri (bucket: str, keys: Iterable[str]) -> str:
 	return "s3://" + bucket + "/" + "/".join(keys)
 
+class S3MultipartSink (NativeSink):
+	'''
+	Uploads the output of the pipeline using the multipart upload API. The
+	parts are uploaded concurrently on the thread pool of the backend. The
+	number of part buffers is bounded so that the memory usage does not grow
+	when the network is slower than the pipeline.
+	'''
+	def __init__ (
+			self,
+			bb,
+			key: str,
+			part_size: int,
+			nb_bufs: int,
+			fp: str = None,
+			checksum: str = None):
+		self.bb = bb
+		self.key = key
+		self.fp = fp
+		self.checksum = checksum
+		self.part_size = part_size
+		self.nb_bufs = nb_bufs
+		self.free_q = Queue()
+		self.nb_allocd = 0
+		self.buf = None
+		self.buf_len = 0
+		self.upload_id = None
+		self.parts = list[Future]()
+		self.size = 0
+
+	def _extra_args (self) -> dict:
+		ret = {}
+		if self.bb.sc_sink:
+			ret["StorageClass"] = self.bb.sc_sink
+		if self.fp is not None:
+			ret["Metadata"] = { CONST.FP_META.value: self.fp }
+		if self.checksum is not None:
+			ret["ChecksumAlgorithm"] = self.checksum
+		return ret
+
+	def _next_part_size (self) -> int:
+		return self.part_size << (len(self.parts) // CONST.PART_SIZE_STEP.value)
+
+	def _get_buf (self) -> bytearray:
+		if self.free_q.empty() and self.nb_allocd < self.nb_bufs:
+			self.nb_allocd += 1
+			ret = bytearray()
+		else:
+			# Block until one of the parts is uploaded
+			ret = self.free_q.get()
+			if isinstance(ret, BaseException):
+				raise ret
+
+		size = self._next_part_size()
+		if len(ret) < size:
+			ret = bytearray(size)
+		return ret
+
+	def _do_upload_part (self, buf: bytearray, l: int, nb: int) -> dict:
+		extra = {}
+		if self.checksum is not None:
+			extra["ChecksumAlgorithm"] = self.checksum
+
+		try:
+			r = self.bb.client.upload_part(
+				Bucket = self.bb.bucket,
+				Key = self.key,
+				UploadId = self.upload_id,
+				PartNumber = nb,
+				# Avoid copying the full parts
+				Body = buf if len(buf) == l else buf[:l],
+				**extra)
+		except BaseException as e:
+			self.free_q.put(e)
+			raise
+		self.free_q.put(buf)
+
+		ret = { "ETag": r["ETag"], "PartNumber": nb }
+		if self.checksum is not None:
+			k = "Checksum" + self.checksum
+			ret[k] = r[k]
+		return ret
+
+	def _flush_buf (self):
+		if self.upload_id is None:
+			r = self.bb.client.create_multipart_upload(
+				Bucket = self.bb.bucket,
+				Key = self.key,
+				**self._extra_args())
+			self.upload_id = r["UploadId"]
+
+		if len(self.parts) >= CONST.MAX_PARTS.value:
+			raise OverflowError("Too many parts", self.key)
+
+		self.parts.append(self.bb.th_pool.submit(
+			self._do_upload_part,
+			self.buf,
+			self.buf_len,
+			len(self.parts) + 1))
+		self.buf = None
+		self.buf_len = 0
+
+	def _buf_room (self) -> memoryview:
+		if self.buf is None:
+			self.buf = self._get_buf()
+		return memoryview(self.buf)[self.buf_len:self._next_part_size()]
+
+	def write (self, ctx: GlobalContext, b) -> int:
+		mv = memoryview(b)
+		ret = len(mv)
+
+		while mv:
+			room = self._buf_room()
+			l = min(len(room), len(mv))
+			room[:l] = mv[:l]
+			self.buf_len += l
+			mv = mv[l:]
+			if self.buf_len >= self._next_part_size():
+				self._flush_buf()
+		self.size += ret
+
+		return ret
+
+	def drain (self, ctx: GlobalContext, fd: int) -> int:
+		ret = 0
+
+		while True:
+			# Read directly into the part buffer
+			room = self._buf_room()
+			n = os.readv(fd, [ room[:ctx.child_io_size] ])
+			if n == 0:
+				break
+			self.buf_len += n
+			ret += n
+			if self.buf_len >= self._next_part_size():
+				self._flush_buf()
+		self.size += ret
+
+		return ret
+
+	def close (self, ctx: GlobalContext):
+		if self.upload_id is None:
+			# Small enough for a single request
+			body = self.buf[:self.buf_len] if self.buf else b""
+			self.bb.client.put_object(
+				Bucket = self.bb.bucket,
+				Key = self.key,
+				Body = body,
+				**self._extra_args())
+			return
+
+		try:
+			if self.buf_len > 0:
+				self._flush_buf()
+			parts = [ i.result() for i in self.parts ]
+			self.bb.client.complete_multipart_upload(
+				Bucket = self.bb.bucket,
+				Key = self.key,
+				UploadId = self.upload_id,
+				MultipartUpload = { "Parts": parts })
+		except:
+			# Don't leave the parts uploaded to be billed for
+			self.abort(ctx)
+			raise
+
+	def abort (self, ctx: GlobalContext):
+		if self.upload_id is None:
+			return
+
+		for i in self.parts:
+			try: i.result()
+			except: pass
+		try:
+			self.bb.client.abort_multipart_upload(
+				Bucket = self.bb.bucket,
+				Key = self.key,
+				UploadId = self.upload_id)
+		except: pass
+
+	def __str__ (self) -> str:
+		return "native > " + mks3uri(self.bb.bucket, [ self.key ])
+
 class S3BackupBackend (BackupBackend):
 	def __init__ (self, param: dict):
 		self.profile = param.get("profile", "default")
+		self.endpoint_url = param.get("endpoint-url")
+		self.region = param.get("region")
 		self.bucket = param["bucket"]
 		self.root_key = mks3objkey([param["root"]])
 		self.mkprefix = BackupBackend.mkprefix_iso8601
@@ -51,15 +270,79 @@ class S3BackupBackend (BackupBackend):
 		self.cur_backup_key = None
 		self.sc_sink = param.get("sink-storage-class")
 		self.sc_rot = param.get("rot-storage-class")
+		self.sink_type = param.get("sink", "native")
+		self.part_size = param.get("part-size")
+		self.rot_part_size = int(param.get(
+			"rot-part-size",
+			CONST.DEFAULT_ROT_PART_SIZE.value))
+		self.rot_concurrency = param.get("rot-concurrency")
+		self.rot_async = param.get("rot-async", False)
+		self.parts_inflight = int(param.get(
+			"parts-inflight",
+			CONST.DEFAULT_PARTS_INFLIGHT.value))
 		self.client = None
+		self.th_pool = None
 		self.sink_list = list[str]()
+		self.lock = threading.Lock()
+		# The multipart uploads of the transition running in the background
+		self.rot_uploads = set[str]()
+		self.prev_copy = None
+		self.prev_manifest = None
+		self.sink_objs = dict[str, BackupObject]()
+
+		if not self.sink_type in { "native", "awscli" }:
+			raise InvalidConfigError("Invalid 'sink'", self.sink_type)
+		if (self.part_size is not None and
+			self.part_size < CONST.MIN_PART_SIZE.value):
+			raise InvalidConfigError("'part-size' too small", self.part_size)
+		if not (CONST.MIN_PART_SIZE.value <=
+			self.rot_part_size <=
+			CONST.MAX_COPY_SIZE.value):
+			raise InvalidConfigError(
+				"Invalid 'rot-part-size'",
+				self.rot_part_size)
+		if self.parts_inflight <= 0:
+			raise InvalidConfigError(
+				"Invalid 'parts-inflight'",
+				self.parts_inflight)
+
+	def _awscli_argv (self) -> list[str]:
+		ret = [ CONST.AWSCLI.value, "--profile=" + self.profile ]
+		if self.endpoint_url:
+			ret.append("--endpoint-url=" + self.endpoint_url)
+		if self.region:
+			ret.append("--region=" + self.region)
+		return ret
+
+	def _mkclient (self, ctx: GlobalContext, nb_conns: int = None):
+		# Share the connections with all the threads in the pool
+		config = Config(max_pool_connections = nb_conns or nb_pool_workers(ctx))
+
+		return boto3.Session(
+			profile_name = self.profile,
+			region_name = self.region).client(
+				"s3",
+				endpoint_url = self.endpoint_url,
+				config = config)
+
+	def _calc_part_size (self, bo) -> int:
+		if self.part_size is not None:
+			return self.part_size
+		if bo.alloc_size is None:
+			return CONST.DEFAULT_PART_SIZE.value
+
+		ret = -(-bo.alloc_size // CONST.MAX_PARTS.value)
+		# Align to MiB
+		ret = (ret + 1048575) & ~1048575
+		return max(ret, CONST.DEFAULT_PART_SIZE.value)
 
 	def _setup_cur_backup (self, ctx: GlobalContext):
 		self.cur_backup_key = mks3objkey([self.root_key, self.mkprefix()])
 		self.cur_backup_uri = mks3uri(self.bucket, [self.cur_backup_key])
 
 	def open (self, ctx: GlobalContext):
-		self.client = boto3.Session(profile_name = self.profile).client("s3")
+		self.client = self._mkclient(ctx)
+		self.th_pool = ThreadPoolExecutor(max_workers = nb_pool_workers(ctx))
 
 		try:
 			for i in range(0, 2):
@@ -82,6 +365,10 @@ class S3BackupBackend (BackupBackend):
 
 	def _cleanup_multiparts (self, ctx: GlobalContext) -> bool:
 		def do_abort (e):
+			with self.lock:
+				# The transition creates the uploads with the lock held
+				if e["UploadId"] in self.rot_uploads:
+					return
 			try:
 				self.client.abort_multipart_upload(
 					Bucket = self.bucket,
@@ -116,81 +403,295 @@ class S3BackupBackend (BackupBackend):
 				else:
 					break
 
-	def _foreach_objs (self, ctx: GlobalContext, prefix: str, cb: Callable):
+	def _foreach_objs (
+			self,
+			ctx: GlobalContext,
+			prefix: str,
+			cb: Callable,
+			delimiter: str = None,
+			cb_prefix: Callable = None):
 		cont_token = None
+		extra = {}
 
 		if not prefix.endswith("/"): prefix += "/"
+		if delimiter is not None:
+			extra["Delimiter"] = delimiter
 
 		while True:
 			if cont_token:
 				r = self.client.list_objects_v2(
 					Bucket = self.bucket,
 					Prefix = prefix,
-					ContinuationToken = cont_token)
+					ContinuationToken = cont_token,
+					**extra)
 			else:
 				r = self.client.list_objects_v2(
 					Bucket = self.bucket,
-					Prefix = prefix)
+					Prefix = prefix,
+					**extra)
 
-			for i in r["Contents"]:
+			for i in r.get("Contents", iter(())):
 				cb(i)
+			if cb_prefix:
+				for i in r.get("CommonPrefixes", iter(())):
+					cb_prefix(i)
 
 			if r["IsTruncated"]:
 				cont_token = r["NextContinuationToken"]
 			else:
 				break
 
-	def _fs_usage_info (self, ctx: GlobalContext) -> Iterable[tuple[str, int]]:
-		du_map = dict[str, int]()
-		ret = list[tuple[str, int]]()
-		prefix = self.root_key + "/"
-		def cb (i):
-			o_key = i["Key"]
-			o_size = i.get("Size", 0)
-			if not o_key.startswith(self.root_key):
+	def _list_copies (self, ctx: GlobalContext) -> list[str]:
+		ret = list[str]()
+		def cb_prefix (i):
+			p = i["Prefix"]
+			if not p.startswith(self.root_key + "/"):
 				raise APIFailError(
-					"The endpoint returned an object irrelevant to the request",
-					o_key)
+					"The endpoint returned a prefix irrelevant to the request",
+					p)
+			ret.append(p.rstrip("/"))
+
+		self._foreach_objs(ctx, self.root_key, lambda i: None, "/", cb_prefix)
+
+		return ret
+
+	def _copy_size (self, ctx: GlobalContext, copy: str) -> tuple[int, bool]:
+		'''
+		Return the size of the copy and whether the copy has the manifest,
+		i.e. whether the copy is complete.
+		'''
+		ret = 0
+		manifest = self._manifest_key(copy)
+		complete = False
+		def cb (i):
+			nonlocal ret, complete
+			ret += i.get("Size", 0)
+			complete = complete or i["Key"] == manifest
+
+		self._foreach_objs(ctx, copy, cb)
+
+		return (ret, complete)
+
+	def _index_key (self) -> str:
+		return mks3objkey([ self.root_key, CONST.INDEX_NAME.value ])
 
-			l = o_key.find("/", len(prefix))
-			if l >= 0:
-				o_backup = o_key[:l]
+	def _load_index (self, ctx: GlobalContext) -> dict[str, int]:
+		try:
+			r = self.client.get_object(Bucket = self.bucket, Key = self._index_key())
+		except botocore.exceptions.ClientError as e:
+			c = e.response["Error"]["Code"]
+			if c in { "NoSuchKey", "404" }:
+				return {}
+			raise
+
+		jobj = json.loads(r["Body"].read())
+		if jobj.get("version") != CONST.INDEX_VERSION.value:
+			self._logger(ctx).warning("discarding index of unsupported version")
+			return {}
+
+		return jobj["copies"]
+
+	def _save_index (self, ctx: GlobalContext, index: dict[str, int]):
+		jobj = {
+			"version": CONST.INDEX_VERSION.value,
+			"copies": index
+		}
+		self.client.put_object(
+			Bucket = self.bucket,
+			Key = self._index_key(),
+			Body = json.dumps(jobj).encode(),
+			ContentType = "application/json")
+
+	def _build_index (
+			self,
+			ctx: GlobalContext,
+			copies: list[str],
+			index: dict[str, int]) -> tuple[dict[str, int], dict[str, int]]:
+		'''
+		Return the sizes of the copies and the new index. The copies that are
+		already in the index are not listed as the copies are immutable once
+		they're made. The copies in the making(the current one and the ones
+		without the manifest, e.g. being uploaded by another run or left
+		incomplete) are listed every time and kept out of the index.
+		'''
+		l = self._logger(ctx)
+		sizes = dict[str, int]()
+		ny_index = dict[str, int]()
+		fl = list[tuple[str, Future]]()
+
+		for i in copies:
+			if i in index and i != self.cur_backup_key:
+				sizes[i] = ny_index[i] = index[i]
 			else:
-				return
+				l.debug("index: listing " + i)
+				fl.append((i, self.th_pool.submit(self._copy_size, ctx, i)))
+		for i, f in fl:
+			sizes[i], complete = f.result()
+			if complete and i != self.cur_backup_key:
+				ny_index[i] = sizes[i]
 
-			du_map[o_backup] = du_map.get(o_backup, 0) + o_size
+		return (sizes, ny_index)
 
-		self._foreach_objs(ctx, prefix, cb)
-		for i in sorted(du_map.keys()):
-			ret.append((i, du_map[i]))
+	def _fs_usage_info (self, ctx: GlobalContext) -> Iterable[tuple[str, int]]:
+		copies = self._list_copies(ctx)
+		index = self._load_index(ctx)
+		sizes, ny_index = self._build_index(ctx, copies, index)
+
+		if ny_index != index:
+			self._save_index(ctx, ny_index)
+
+		return [ (i, sizes[i]) for i in sorted(copies) ]
+
+	def copies (self, ctx: GlobalContext) -> list[str]:
+		self.client = self.client or self._mkclient(ctx)
+		return sorted(
+			i[len(self.root_key) + 1:] for i in self._list_copies(ctx))
+
+	def _get_range (self, key: str, rng: str) -> bytes:
+		r = self.client.get_object(Bucket = self.bucket, Key = key, Range = rng)
+		return r["Body"].read()
+
+	def _hash_obj (self, h, range_pool: ThreadPoolExecutor, key: str, size: int) -> int:
+		'''
+		Fetch the object in ranges in parallel and hash them in order.
+		'''
+		ret = 0
+		rs = CONST.VERIFY_RANGE_SIZE.value
+		fl = list[Future]()
+		offsets = iter(range(0, size, rs))
+
+		def fill ():
+			while len(fl) < CONST.VERIFY_RANGES_INFLIGHT.value:
+				off = next(offsets, None)
+				if off is None:
+					break
+				rng = "bytes=%u-%u" % (off, min(off + rs, size) - 1)
+				fl.append(range_pool.submit(self._get_range, key, rng))
+
+		try:
+			fill()
+			while fl:
+				b = fl.pop(0).result()
+				fill()
+				h.update(b)
+				ret += len(b)
+		finally:
+			for f in fl:
+				f.cancel()
 
 		return ret
 
+	def verify (
+			self,
+			ctx: GlobalContext,
+			copies: Iterable[str]) -> Iterable[VerifyResult]:
+		nb_workers = nb_pool_workers(ctx)
+		# The range pool and the rest
+		self.client = self._mkclient(ctx, nb_workers + 1)
+
+		with (ThreadPoolExecutor(max_workers = nb_workers) as obj_pool,
+			ThreadPoolExecutor(max_workers = nb_workers) as range_pool):
+			fl = list[Future]()
+
+			for copy in copies:
+				copy_key = mks3objkey([ self.root_key, copy ])
+				m = self._load_manifest(copy_key)
+				if m is None:
+					r = VerifyResult(copy, BackupManifest.NAME)
+					r.error = "no manifest"
+					yield r
+					continue
+
+				for path, ent in sorted(m.objects.items()):
+					r = VerifyResult(copy, path, ent)
+					if r.expected is None:
+						yield r
+						continue
+					fl.append(obj_pool.submit(
+						r.run,
+						self._hash_obj,
+						range_pool,
+						mks3objkey([ copy_key, path ]),
+						ent["size"]))
+
+			for f in futures.as_completed(fl):
+				yield f.result()
+
+	def rebuild_index (self, ctx: GlobalContext):
+		self.client = self._mkclient(ctx)
+		with ThreadPoolExecutor(max_workers = nb_pool_workers(ctx)) as th_pool:
+			self.th_pool = th_pool
+			_, index = self._build_index(ctx, self._list_copies(ctx), {})
+			self._save_index(ctx, index)
+
 	def _excl_fs_copies (self, ctx: GlobalContext) -> set[str]:
 		ret = set[str]()
 		ret.add(self.cur_backup_key)
 		return ret
 
+	def _delete_batch (self, batch: list[tuple[str, int]]) -> tuple[int, list]:
+		'''
+		Delete the objects in the batch. The keys that failed are retried.
+		Returns the number of bytes deleted and the errors of the keys that
+		could not be deleted.
+		'''
+		ret = 0
+		size_map = dict(batch)
+		keys = list(size_map.keys())
+
+		for i in range(CONST.DELETE_RETRIES.value):
+			if i > 0:
+				sleep(CONST.DELETE_BACKOFF.value * (1 << (i - 1)))
+
+			r = self.client.delete_objects(
+				Bucket = self.bucket,
+				Delete = {
+					"Objects": [ { "Key": k } for k in keys ],
+					"Quiet": True
+				})
+			errors = r.get("Errors", [])
+			failed = set(e["Key"] for e in errors)
+			ret += sum(size_map[k] for k in keys if not k in failed)
+
+			if not errors:
+				break
+			keys = [ k for k in keys if k in failed ]
+
+		return (ret, errors)
+
 	def _rm_fs_recursive (self, ctx: GlobalContext, pl: Iterable[str]):
 		l = self._logger(ctx)
+		fl = list[Future]()
+		batch = list[tuple[str, int]]()
+		nb_deleted = 0
+		errors = []
 
-		with ThreadPoolExecutor(max_workers = ctx.nb_workers) as th_pool:
-			fl = list[Future]()
+		def flush ():
+			fl.append(self.th_pool.submit(self._delete_batch, list(batch)))
+			batch.clear()
 
+		def cb (i):
+			batch.append((i["Key"], i.get("Size", 0)))
+			if len(batch) >= CONST.MAX_DELETE_KEYS.value:
+				flush()
+
+		try:
 			for i in pl:
-				e = Exec()
-				e.argv = [
-					CONST.AWSCLI.value,
-					"--profile=" + self.profile,
-					"s3",
-					"rm",
-					"--quiet",
-					"--recursive",
-					mks3uri(self.bucket, [i]) ]
-				l.debug("run: " + str(e))
-				fl.append(th_pool.submit(e.run, ctx))
-			for i in fl:
-				i.result()
+				l.debug("rm: " + mks3uri(self.bucket, [ i ]))
+				self._foreach_objs(ctx, i, cb)
+			if batch:
+				flush()
+		finally:
+			for f in fl:
+				d, e = f.result()
+				nb_deleted += d
+				errors.extend(e)
+
+		l.debug("rm: %u bytes deleted in %u requests" % (nb_deleted, len(fl)))
+		if errors:
+			raise APIFailError(
+				"Failed to delete %u objects" % len(errors),
+				errors[:CONST.MAX_ERRORS_SHOWN.value])
 
 	def _fs_quota_target (self, ctx: GlobalContext) -> tuple[Decimal, Decimal]:
 		return (self.nb_copy_limit, self.root_size_limit)
@@ -200,15 +701,30 @@ class S3BackupBackend (BackupBackend):
 			self._rm_fs_recursive(ctx, [self.cur_backup_key])
 
 	def close (self, ctx: GlobalContext):
+		self.th_pool.shutdown()
 		self._cleanup_multiparts(ctx)
 
-	def sink (self, ctx: GlobalContext, bo) -> Exec:
+	def sink (self, ctx: GlobalContext, bo) -> Union[Exec, NativeSink]:
 		l = self._logger(ctx)
 
+		if self.sink_type == "native":
+			key = mks3objkey([self.cur_backup_key, bo.path])
+			ret = S3MultipartSink(
+				self,
+				key,
+				self._calc_part_size(bo),
+				self.parts_inflight,
+				bo.fp,
+				self._s3_checksum(bo))
+
+			l.debug("sink: " + str(ret))
+			self.sink_list.append(key)
+			self.sink_objs[key] = bo
+
+			return ret
+
 		e = Exec()
-		e.argv = [
-			CONST.AWSCLI.value,
-			"--profile=" + self.profile,
+		e.argv = self._awscli_argv() + [
 			"s3",
 			"cp",
 			"--only-show-errors" ]
@@ -216,65 +732,323 @@ class S3BackupBackend (BackupBackend):
 			e.argv.append("--storage-class=" + self.sc_sink)
 		if bo.alloc_size is not None:
 			e.argv.append("--expected-size=" + str(bo.alloc_size))
+		if bo.fp is not None:
+			e.argv.append("--metadata=%s=%s" % (CONST.FP_META.value, bo.fp))
+		if bo.checksum is not None:
+			e.argv.append("--checksum-algorithm=" + self._s3_checksum(bo))
 		e.argv.extend(["-", "/".join([self.cur_backup_uri, bo.path])])
 
 		l.debug("sink: " + str(e))
-		self.sink_list.append(mks3objkey([self.cur_backup_key, bo.path]))
+		key = mks3objkey([self.cur_backup_key, bo.path])
+		self.sink_list.append(key)
+		self.sink_objs[key] = bo
 
 		return e
 
+	def _s3_checksum (self, bo) -> str:
+		if bo.checksum is None:
+			return None
+		return CONST.CHECKSUM_MAP.value.get(bo.checksum, CONST.DEFAULT_CHECKSUM.value)
+
+	def _manifest_key (self, copy: str) -> str:
+		return mks3objkey([ copy, BackupManifest.NAME ])
+
+	def _load_manifest (self, copy: str) -> BackupManifest:
+		try:
+			r = self.client.get_object(
+				Bucket = self.bucket,
+				Key = self._manifest_key(copy))
+		except botocore.exceptions.ClientError as e:
+			if e.response["Error"]["Code"] in { "NoSuchKey", "404" }:
+				return None
+			raise
+
+		return BackupManifest.loads(r["Body"].read())
+
+	def _save_manifest (self, ctx: GlobalContext):
+		m = BackupManifest()
+		sizes = dict[str, int]()
+
+		def cb (i):
+			sizes[i["Key"]] = i.get("Size", 0)
+		self._foreach_objs(ctx, self.cur_backup_key, cb)
+
+		for k, bo in self.sink_objs.items():
+			m.add(bo.path, sizes.get(k, 0), bo)
+		self.client.put_object(
+			Bucket = self.bucket,
+			Key = self._manifest_key(self.cur_backup_key),
+			Body = m.dumps().encode(),
+			ContentType = "application/json")
+
+	def _prev_copy (self, ctx: GlobalContext) -> str:
+		with self.lock:
+			if self.prev_copy is None:
+				self.prev_copy = max(
+					( i for i in self._list_copies(ctx) if i < self.cur_backup_key ),
+					default = "")
+				if self.prev_copy:
+					self.prev_manifest = self._load_manifest(self.prev_copy)
+			return self.prev_copy
+
+	def reuse (self, ctx: GlobalContext, bo) -> bool:
+		prev = self._prev_copy(ctx)
+		if not prev:
+			return False
+
+		src = mks3objkey([prev, bo.path])
+		try:
+			h = self.client.head_object(Bucket = self.bucket, Key = src)
+		except botocore.exceptions.ClientError as e:
+			if e.response["Error"]["Code"] in { "NoSuchKey", "404" }:
+				return False
+			raise
+		if h.get("Metadata", {}).get(CONST.FP_META.value) != bo.fp:
+			return False
+		if (h.get("StorageClass") in CONST.ARCHIVE_SC.value or
+			"ArchiveStatus" in h):
+			# Not copyable until restored. Make it again
+			return False
+		if self.prev_manifest is not None:
+			digest = self.prev_manifest.objects.get(bo.path, {}).get("digest")
+		else:
+			digest = None
+		if not bo.test_digest(digest):
+			return False
+
+		key = mks3objkey([self.cur_backup_key, bo.path])
+		extra = {
+			"Metadata": { CONST.FP_META.value: bo.fp },
+			"MetadataDirective": "REPLACE"
+		}
+		if self.sc_sink:
+			extra["StorageClass"] = self.sc_sink
+		if bo.checksum is not None:
+			extra["ChecksumAlgorithm"] = self._s3_checksum(bo)
+
+		l = self._logger(ctx)
+		l.debug("reuse: %s -> %s" % (src, key))
+		try:
+			self.client.copy(
+				{ "Bucket": self.bucket, "Key": src },
+				self.bucket,
+				key,
+				extra)
+		except botocore.exceptions.ClientError as e:
+			l.warning("reuse: %s: copy failed, making it again: %s" % (
+				src,
+				str(e)))
+			return False
+		bo.digest = digest
+		self.sink_list.append(key)
+		self.sink_objs[key] = bo
+
+		return True
+
+	def _transition_part_size (self, size: int) -> int:
+		return max(self.rot_part_size, -(-size // CONST.MAX_PARTS.value))
+
+	def _transition (self, ctx: GlobalContext, keys: list[str], sc: str):
+		'''
+		Change the storage class of the objects by copying them onto
+		themselves. The objects larger than the part size are copied using
+		UploadPartCopy so that the parts are copied in parallel.
+		'''
+		l = self._logger(ctx)
+		nb_workers = self.rot_concurrency or nb_pool_workers(ctx)
+
+		def head (k: str) -> dict:
+			return self.client.head_object(Bucket = self.bucket, Key = k)
+
+		def copy_part (
+				k: str,
+				upload_id: str,
+				nb: int,
+				rng: str,
+				checksum: str) -> dict:
+			r = self.client.upload_part_copy(
+				Bucket = self.bucket,
+				Key = k,
+				UploadId = upload_id,
+				PartNumber = nb,
+				CopySource = { "Bucket": self.bucket, "Key": k },
+				CopySourceRange = rng)["CopyPartResult"]
+			ret = { "ETag": r["ETag"], "PartNumber": nb }
+			ck = "Checksum" + str(checksum)
+			if ck in r:
+				ret[ck] = r[ck]
+			return ret
+
+		def end_upload (k: str, upload_id: str, parts: list[dict] = None):
+			try:
+				if parts is None:
+					self.client.abort_multipart_upload(
+						Bucket = self.bucket,
+						Key = k,
+						UploadId = upload_id)
+				else:
+					self.client.complete_multipart_upload(
+						Bucket = self.bucket,
+						Key = k,
+						UploadId = upload_id,
+						MultipartUpload = { "Parts": parts })
+			finally:
+				with self.lock:
+					self.rot_uploads.discard(upload_id)
+
+		with ThreadPoolExecutor(max_workers = nb_workers) as th_pool:
+			heads = list(zip(keys, th_pool.map(head, keys)))
+			fl = list[Future]()
+			mpu = list[tuple[str, str, list[Future]]]()
+
+			try:
+				for k, h in heads:
+					size = h["ContentLength"]
+					if h.get("StorageClass", "STANDARD") == sc:
+						l.debug("chsc: skipping %s already in %s" % (k, sc))
+						continue
+					l.debug("chsc: %s %s" % (sc, k))
+					# Keep the checksum the object was uploaded with
+					checksum = self._s3_checksum(self.sink_objs[k])
+					extra = { "StorageClass": sc }
+					if checksum is not None:
+						extra["ChecksumAlgorithm"] = checksum
+
+					part_size = self._transition_part_size(size)
+					if size <= part_size:
+						fl.append(th_pool.submit(
+							self.client.copy_object,
+							Bucket = self.bucket,
+							Key = k,
+							CopySource = { "Bucket": self.bucket, "Key": k },
+							MetadataDirective = "COPY",
+							**extra))
+						continue
+
+					extra["Metadata"] = h.get("Metadata", {})
+					if "ContentType" in h:
+						extra["ContentType"] = h["ContentType"]
+					with self.lock:
+						upload_id = self.client.create_multipart_upload(
+							Bucket = self.bucket,
+							Key = k,
+							**extra)["UploadId"]
+						self.rot_uploads.add(upload_id)
+					parts = list[Future]()
+					mpu.append((k, upload_id, parts))
+					for nb, i in enumerate(range(0, size, part_size)):
+						rng = "bytes=%u-%u" % (i, min(i + part_size, size) - 1)
+						parts.append(th_pool.submit(
+							copy_part,
+							k,
+							upload_id,
+							nb + 1,
+							rng,
+							checksum))
+
+				for f in fl:
+					f.result()
+				while mpu:
+					k, upload_id, parts = mpu[0]
+					end_upload(k, upload_id, [ f.result() for f in parts ])
+					del mpu[0]
+			except:
+				for k, upload_id, parts in mpu:
+					for f in parts: f.cancel()
+					try: end_upload(k, upload_id)
+					except: pass
+				raise
+
 	def rotate (self, ctx: GlobalContext):
+		self._save_manifest(ctx)
 		ret = super()._do_fs_rotate(ctx)
 
 		if self.sc_rot and self.sc_rot != self.sc_sink:
-			def chsc (k):
-				cp_src = {
-					"Bucket": self.bucket,
-					"Key": k
-				}
-				extra = { "StorageClass": self.sc_rot }
-				self.client.copy(cp_src, self.bucket, k, extra)
-
-			with ThreadPoolExecutor(max_workers = ctx.nb_workers) as th_pool:
-				l = self._logger(ctx)
-				fl = list[Future]()
-
-				for i in self.sink_list:
-					l.debug("chsc: %s %s" % (self.sc_rot, i))
-					fl.append(th_pool.submit(chsc, i))
-				for i in fl:
-					i.result()
+			keys = list(self.sink_list)
+
+			if self.rot_async:
+				# Off the critical path. The objects are already in place.
+				ctx.run_bg(
+					"chsc:" + self.cur_backup_key,
+					self._transition,
+					ctx,
+					keys,
+					self.sc_rot)
+			else:
+				self._transition(ctx, keys, self.sc_rot)
 
 		return ret
 
 	def __str__ (self):
 		return '''aws-s3:
 	profile: {profile}
+	endpoint_url: {endpoint_url}
+	region: {region}
 	bucket: {bucket}
 	root_key: {root_key}
 	nb_copy_limit: {nb_copy_limit}
 	root_size_limit: {root_size_limit}
 	sc_sink: {sc_sink}
-	sc_rot: {sc_rot}'''.format(
+	sc_rot: {sc_rot}
+	sink: {sink}
+	part_size: {part_size}
+	parts_inflight: {parts_inflight}
+	rot_part_size: {rot_part_size}
+	rot_concurrency: {rot_concurrency}
+	rot_async: {rot_async}'''.format(
 		profile = self.profile,
+		endpoint_url = self.endpoint_url,
+		region = self.region,
 		bucket = self.bucket,
 		root_key = self.root_key,
 		nb_copy_limit = self.nb_copy_limit,
 		root_size_limit = self.root_size_limit,
 		sc_sink = self.sc_sink,
-		sc_rot = self.sc_rot)
+		sc_rot = self.sc_rot,
+		sink = self.sink_type,
+		part_size = self.part_size,
+		parts_inflight = self.parts_inflight,
+		rot_part_size = self.rot_part_size,
+		rot_concurrency = self.rot_concurrency,
+		rot_async = self.rot_async)
 
 class AwsSnsMUA (MUA):
+	clients = dict[tuple, object]()
+	clients_lock = threading.Lock()
+
 	def __init__ (self, jobj: dict):
+		super().__init__(jobj)
 		self.profile = jobj.get("profile", "default")
 		self.region = jobj.get("region", None)
+		self.endpoint_url = jobj.get("endpoint-url")
 
 	def __str__ (self) -> str:
 		return '''aws-sns:
 	profile: {profile}
-	region: {region}'''.format(
+	region: {region}
+	endpoint-url: {endpoint_url}
+	concurrency: {concurrency}
+	retries: {retries}'''.format(
 		profile = self.profile,
-		region = self.region)
+		region = self.region,
+		endpoint_url = self.endpoint_url,
+		concurrency = self.concurrency,
+		retries = self.retries)
+
+	def _get_client (self):
+		# The clients are thread-safe. Reuse them across sends.
+		k = (self.profile, self.region, self.endpoint_url, self.concurrency)
+		with AwsSnsMUA.clients_lock:
+			ret = AwsSnsMUA.clients.get(k)
+			if ret is None:
+				ret = AwsSnsMUA.clients[k] = boto3.Session(
+					profile_name = self.profile,
+					region_name = self.region).client(
+						"sns",
+						endpoint_url = self.endpoint_url,
+						config = Config(
+							max_pool_connections = self.concurrency))
+		return ret
 
 	def do_send(
 		self,
@@ -282,21 +1056,17 @@ class AwsSnsMUA (MUA):
 		recipients: Iterable[str],
 		subject: str,
 		composer: Iterable[str]) -> int:
-		lines = list[str]()
-		client = boto3.Session(
-			profile_name = self.profile,
-			region_name = self.region).client("sns")
-
-		for l in composer:
-			lines.append(l)
+		client = self._get_client()
+		msg = "".join(composer)
 
-		for i in recipients:
+		def send (r: str):
 			client.publish(
-				TargetArn = i,
+				TargetArn = r,
 				Subject = subject,
-				Message = "".join(lines))
+				Message = msg)
 
-		return 0
+		results = self.deliver(ctx, recipients, send)
+		return 0 if all(i.ok() for i in results) else 1
 
 muas = {
 	"aws-sns": AwsSnsMUA
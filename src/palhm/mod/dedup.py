@@ -0,0 +1,336 @@
+# Copyright (c) 2022 David Timber <dxdt@dev.snart.me>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+import hashlib
+import os
+import shutil
+import threading
+import zlib
+from enum import Enum
+from typing import Iterable, Union
+
+from palhm import (BackupManifest, Exec, GlobalContext, LocalfsBackupBackend,
+				   NativeSink, hash_file, write_fully)
+from palhm.exceptions import InvalidConfigError
+
+
+class CONST (Enum):
+	CHUNK_DIR = ".palhm-chunks"
+	DEFAULT_CHUNK_MIN = 65536 # 64KiB
+	DEFAULT_CHUNK_AVG = 262144 # 256KiB
+	DEFAULT_CHUNK_MAX = 4194304 # 4MiB
+	WINDOW = 64
+	ANCHOR = b"\n"
+
+class Chunker:
+	'''
+	Content-defined chunker. The cut points are only considered at the anchor
+	bytes so that the stream is scanned at the speed of bytes.find() rather
+	than byte by byte. A newline is taken as a cut point if the CRC of the
+	window before it is below the threshold proportional to the length of the
+	line, which makes the odds of a cut roughly 1/avg per byte. The stream is
+	cut at max if no cut point is found.
+	'''
+	def __init__ (self, cmin: int, cavg: int, cmax: int):
+		self.cmin = cmin
+		self.cavg = cavg
+		self.cmax = cmax
+		self.buf = bytearray()
+		self.pos = 0 # scan position
+		self.last_nl = -1 # position of the previous anchor
+
+	def _cut (self, n: int) -> bytes:
+		ret = bytes(self.buf[:n])
+		del self.buf[:n]
+		self.pos = 0
+		self.last_nl -= n
+		return ret
+
+	def _find_cut (self) -> int:
+		buf = self.buf
+		mv = memoryview(buf)
+		end = min(len(buf), self.cmax)
+
+		if self.pos < self.cmin - 1:
+			p = buf.rfind(CONST.ANCHOR.value, self.pos, self.cmin - 1)
+			if p >= 0:
+				self.last_nl = p
+			self.pos = self.cmin - 1
+
+		while True:
+			i = buf.find(CONST.ANCHOR.value, self.pos, end)
+			if i < 0:
+				break
+
+			l = i - self.last_nl
+			h = zlib.crc32(mv[max(0, i - CONST.WINDOW.value + 1):i + 1])
+			self.last_nl = i
+			self.pos = i + 1
+			if h * self.cavg < l << 32:
+				return i + 1
+
+		if end >= self.cmax:
+			return self.cmax
+		self.pos = end
+		return 0
+
+	def feed (self, b) -> Iterable[bytes]:
+		self.buf += b
+
+		while len(self.buf) >= self.cmin:
+			n = self._find_cut()
+			if not n:
+				break
+			yield self._cut(n)
+
+	def flush (self) -> bytes:
+		return self._cut(len(self.buf))
+
+class DedupSink (NativeSink):
+	def __init__ (self, backend, bo):
+		self.backend = backend
+		self.bo = bo
+		self.path = bo.path
+		self.chunker = Chunker(backend.chunk_min, backend.chunk_avg, backend.chunk_max)
+		self.chunks = list[list]()
+		self.size = 0
+
+	def _put (self, c: bytes):
+		self.chunks.append([ self.backend._put_chunk(c), len(c) ])
+
+	def write (self, ctx: GlobalContext, b) -> int:
+		for c in self.chunker.feed(b):
+			self._put(c)
+		self.size += len(b)
+
+		return len(b)
+
+	def close (self, ctx: GlobalContext):
+		if self.chunker is None:
+			return
+
+		c = self.chunker.flush()
+		self.chunker = None
+		if c:
+			self._put(c)
+		self.backend._add_recipe(self.bo, self.size, self.chunks)
+
+	def abort (self, ctx: GlobalContext):
+		self.chunker = None
+
+	def __str__ (self) -> str:
+		return "dedup > " + self.path
+
+class DedupLocalfsBackupBackend (LocalfsBackupBackend):
+	'''
+	Stores the backup objects as content-defined chunks in the chunk store
+	under the root. A backup copy is the manifest listing the chunks of the
+	objects. The chunks are reference counted by the copies and deleted when
+	the last copy referencing them is rotated out.
+	'''
+	def __init__ (self, param: dict):
+		super().__init__(param)
+
+		self.chunk_min = int(param.get("chunk-min", CONST.DEFAULT_CHUNK_MIN.value))
+		self.chunk_avg = int(param.get("chunk-avg", CONST.DEFAULT_CHUNK_AVG.value))
+		self.chunk_max = int(param.get("chunk-max", CONST.DEFAULT_CHUNK_MAX.value))
+		self.chunk_root = os.sep.join([ self.backup_root, CONST.CHUNK_DIR.value ])
+		self.recipes = BackupManifest()
+		self.new_chunks = list[str]()
+		self.refs = dict[str, int]()
+		self.copy_chunks = dict[str, set[str]]()
+		self.nb_written = 0
+
+		if self.sink_type != "native":
+			raise InvalidConfigError("Invalid 'sink'", self.sink_type)
+		if not (0 < self.chunk_min <= self.chunk_max and self.chunk_avg > 0):
+			raise InvalidConfigError(
+				"Invalid chunk size",
+				(self.chunk_min, self.chunk_avg, self.chunk_max))
+
+	def rollback (self, ctx: GlobalContext):
+		super().rollback(ctx)
+
+		for i in self.new_chunks:
+			try: os.unlink(i)
+			except FileNotFoundError: pass
+
+	def sink (self, ctx: GlobalContext, bo) -> Union[Exec, NativeSink]:
+		return DedupSink(self, bo)
+
+	def _chunk_path (self, h: str) -> str:
+		return os.sep.join([ self.chunk_root, h[:2], h ])
+
+	def _put_chunk (self, c: bytes) -> str:
+		h = hashlib.sha256(c).hexdigest()
+		path = self._chunk_path(h)
+
+		if os.path.exists(path):
+			return h
+
+		os.makedirs(os.path.dirname(path), self.dmode, True)
+		tmp = "%s.%u.%u.tmp" % (path, os.getpid(), threading.get_ident())
+		fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, self.fmode)
+		try:
+			write_fully(fd, c)
+		finally:
+			os.close(fd)
+
+		try:
+			os.link(tmp, path)
+			with self.lock:
+				self.new_chunks.append(path)
+				self.nb_written += len(c)
+		except FileExistsError:
+			pass
+		finally:
+			os.unlink(tmp)
+
+		return h
+
+	def _add_recipe (self, bo, size: int, chunks: list[list]):
+		with self.lock:
+			self.recipes.add(bo.path, size, bo)["chunks"] = chunks
+
+	def reuse (self, ctx: GlobalContext, bo) -> bool:
+		# The chunks are held by the previous copy until the rotation
+		prev, ent = self._prev_object(bo)
+		if prev is None:
+			return False
+
+		self._logger(ctx).debug("reuse: %s/%s" % (prev, bo.path))
+		bo.digest = ent.get("digest")
+		self._add_recipe(bo, ent["size"], ent["chunks"])
+
+		return True
+
+	def _hash_obj (self, h, copy_path: str, path: str, ent: dict) -> int:
+		ret = 0
+		for c, size in ent.get("chunks", iter(())):
+			ret += hash_file(self._chunk_path(c), h)
+		return ret
+
+	def _copy_dirs (self) -> list[os.DirEntry]:
+		return [
+			i for i in super()._copy_dirs()
+				if i.name != CONST.CHUNK_DIR.value
+		]
+
+	def _fs_usage_info (self, ctx: GlobalContext) -> Iterable[tuple[str, int]]:
+		# The size of a chunk is accounted to the newest copy referencing it so
+		# that the sizes of the copies deleted oldest first add up to the
+		# space actually freed.
+		l = self._logger(ctx)
+		owner = dict[str, tuple[str, int]]()
+		dirs = self._copy_dirs()
+
+		self.refs.clear()
+		self.copy_chunks.clear()
+		for i in dirs:
+			m = self._read_manifest(i.path)
+			cs = set[str]()
+
+			if m is None:
+				l.warning("no manifest. Incomplete copy?: " + i.path)
+			else:
+				for o in m.objects.values():
+					for h, size in o.get("chunks", iter(())):
+						cs.add(h)
+						owner[h] = (i.path, size)
+
+			for h in cs:
+				self.refs[h] = self.refs.get(h, 0) + 1
+			self.copy_chunks[i.path] = cs
+
+		usage = dict[str, int]()
+		for path, size in owner.values():
+			usage[path] = usage.get(path, 0) + size
+
+		return [ (i.path, usage.get(i.path, 0)) for i in dirs ]
+
+	def _rm_fs_recursive (self, ctx: GlobalContext, pl: Iterable[str]):
+		l = self._logger(ctx)
+
+		for i in pl:
+			l.debug("rm: " + i)
+			shutil.rmtree(i)
+
+			for h in self.copy_chunks.pop(i, iter(())):
+				self.refs[h] -= 1
+				if self.refs[h] <= 0:
+					del self.refs[h]
+					try: os.unlink(self._chunk_path(h))
+					except FileNotFoundError: pass
+
+	def rebuild_index (self, ctx: GlobalContext):
+		# The manifests are the only source of truth. Sweep the chunks that
+		# no copy refers to, the ones left behind by interrupted runs.
+		l = self._logger(ctx)
+		refs = set[str]()
+		nb_swept = 0
+
+		for i in self._copy_dirs():
+			m = self._read_manifest(i.path)
+			if m is None:
+				l.warning("no manifest. Incomplete copy?: " + i.path)
+				continue
+			for o in m.objects.values():
+				refs.update(h for h, size in o.get("chunks", iter(())))
+
+		for root, dirs, files in os.walk(self.chunk_root):
+			for f in files:
+				if f in refs:
+					continue
+				l.debug("sweep: " + f)
+				os.unlink(os.path.join(root, f))
+				nb_swept += 1
+
+		l.info("reindex: %u chunks in use, %u swept" % (len(refs), nb_swept))
+
+	def rotate (self, ctx: GlobalContext):
+		l = self._logger(ctx)
+
+		self._write_manifest(self.cur_backup_path, self.recipes)
+		l.debug("dedup: %u bytes in, %u bytes written" %
+			(self.recipes.total(), self.nb_written))
+
+		return self._do_fs_rotate(ctx)
+
+	def __str__ (self):
+		return '''dedup-localfs:
+	root: {root}
+	nb_copy_limit: {nb_copy_limit}
+	root_size_limit: {root_size_limit}
+	dmode: {dmode:o}
+	fmode: {fmode:o}
+	chunk_min: {chunk_min}
+	chunk_avg: {chunk_avg}
+	chunk_max: {chunk_max}'''.format(
+		root = self.backup_root,
+		nb_copy_limit = self.nb_copy_limit,
+		root_size_limit = self.root_size_limit,
+		dmode = self.dmode,
+		fmode = self.fmode,
+		chunk_min = self.chunk_min,
+		chunk_avg = self.chunk_avg,
+		chunk_max = self.chunk_max)
+
+backup_backends = {
+	"dedup-localfs": DedupLocalfsBackupBackend
+}
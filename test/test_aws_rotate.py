@@ -0,0 +1,135 @@
+#!/usr/bin/env python3
+# Run from the root of the repo: python3 -m unittest discover -s test
+import os
+import sys
+import tempfile
+import threading
+import unittest
+from unittest import mock
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src"))
+
+try:
+	import boto3
+	from moto import mock_aws
+except ImportError:
+	mock_aws = None
+
+import palhm
+
+BUCKET = "palhm-test"
+OBJ_SIZE = 12 * 1024 * 1024
+
+@unittest.skipIf(mock_aws is None, "boto3 and moto required")
+class AsyncRotateTest (unittest.TestCase):
+	'''
+	The storage class transition running in the background must survive the
+	cleanup of the multipart uploads in close().
+	'''
+	def setUp (self):
+		self.tmp = tempfile.TemporaryDirectory()
+		cred = os.path.join(self.tmp.name, "credentials")
+		with open(cred, "w") as f:
+			f.write(
+				"[default]\n"
+				"aws_access_key_id = test\n"
+				"aws_secret_access_key = test\n")
+		env = mock.patch.dict(os.environ, {
+			"AWS_SHARED_CREDENTIALS_FILE": cred,
+			"AWS_CONFIG_FILE": os.path.join(self.tmp.name, "config")
+		})
+		env.start()
+		self.addCleanup(env.stop)
+		self.addCleanup(self.tmp.cleanup)
+
+		m = mock_aws()
+		m.start()
+		self.addCleanup(m.stop)
+		self.client = boto3.client("s3", region_name = "us-east-1")
+		self.client.create_bucket(Bucket = BUCKET)
+
+	def mkctx (self) -> palhm.GlobalContext:
+		return palhm.setup_conf({
+			"modules": [ "aws" ],
+			"vl": 0,
+			"tasks": [
+				{
+					"id": "s3",
+					"type": "backup",
+					"checksum": "sha256",
+					"backend": "aws-s3",
+					"backend-param": {
+						"bucket": BUCKET,
+						"root": "root",
+						"region": "us-east-1",
+						"rot-storage-class": "STANDARD_IA",
+						"rot-part-size": 5 * 1024 * 1024,
+						"rot-async": True
+					},
+					"objects": [
+						{
+							"path": "big",
+							"pipeline": [
+								{
+									"type": "exec-inline",
+									"argv": [
+										"/bin/head",
+										"-c",
+										str(OBJ_SIZE),
+										"/dev/zero" ]
+								}
+							]
+						}
+					]
+				}
+			]
+		})
+
+	def test_close_during_transition (self):
+		ctx = self.mkctx()
+		bb = ctx.task_map["s3"].bb
+		cleaned = threading.Event()
+		mkclient = bb._mkclient
+		cleanup = bb._cleanup_multiparts
+
+		def hold_parts (**kwargs):
+			# Copy the parts only after close() is done with the cleanup
+			cleaned.wait(10)
+
+		def hooked_mkclient (*args, **kwargs):
+			ret = mkclient(*args, **kwargs)
+			ret.meta.events.register(
+				"before-call.s3.UploadPartCopy",
+				hold_parts)
+			return ret
+
+		def hooked_cleanup (ctx):
+			try:
+				# Wait for the transition to create the upload
+				for i in range(100):
+					if bb.rot_uploads:
+						break
+					threading.Event().wait(0.1)
+				self.assertTrue(bb.rot_uploads)
+				cleanup(ctx)
+			finally:
+				cleaned.set()
+
+		with (mock.patch.object(bb, "_mkclient", hooked_mkclient),
+			mock.patch.object(bb, "_cleanup_multiparts", hooked_cleanup)):
+			ctx.task_map["s3"].run(ctx)
+			ctx.join_bg()
+
+		key = bb.sink_list[0]
+		h = self.client.head_object(
+			Bucket = BUCKET,
+			Key = key,
+			ChecksumMode = "ENABLED")
+		self.assertEqual(h["StorageClass"], "STANDARD_IA")
+		self.assertEqual(h["ContentLength"], OBJ_SIZE)
+		self.assertIn("ChecksumSHA256", h)
+		self.assertFalse(
+			self.client.list_multipart_uploads(Bucket = BUCKET).get("Uploads"))
+
+if __name__ == "__main__":
+	unittest.main()